@@ -1,21 +1,175 @@
-import math
+import bisect
+import functools
 import pathlib
-from collections.abc import Mapping
+from collections import OrderedDict
+from collections.abc import Iterator, Mapping, Sequence
+from concurrent.futures import Future, ThreadPoolExecutor
 from io import BytesIO
-from typing import Union
+from threading import Lock
+from typing import NamedTuple, Union
 from xml.etree.ElementTree import Element, ElementTree, SubElement
 
 import cupy as cp
 import numpy as np
 from cucim import CuImage
+from cucim.skimage.transform import resize as cu_resize
 from PIL import Image
-from skimage.util import img_as_float32
 
-from dz_py.util import lazyproperty
+from dz_py.util import LazyMapping, lazyproperty, max_dzi_level, morton_order
+
+try:
+    from nvidia import nvimgcodec
+except ImportError:  # GPU JPEG encode is optional
+    nvimgcodec = None
+
+try:
+    import simplejpeg
+except ImportError:  # libjpeg-turbo bindings are optional, PIL encodes
+    simplejpeg = None
+
+try:
+    from numba import njit
+except ImportError:  # without numba the region math runs as plain Python
+
+    def njit(*args, **kwargs):  # pylint: disable=unused-argument
+        if args and callable(args[0]):
+            return args[0]
+        return lambda f: f
+
+
+@functools.cache
+def _jpeg_encoder():
+    """Return the shared nvImageCodec encoder, or None if unavailable."""
+    if nvimgcodec is None:
+        return None
+    return nvimgcodec.Encoder()
+
+
+def _encode_jpeg_host(array: np.ndarray, quality: int) -> bytes:
+    """Encode an RGB uint8 numpy array as JPEG, with libjpeg-turbo through
+    simplejpeg when available."""
+    if simplejpeg is not None:
+        return simplejpeg.encode_jpeg(array, quality=quality, colorspace="RGB")
+    buf = BytesIO()
+    Image.fromarray(array).save(buf, "jpeg", quality=quality)
+    return buf.getvalue()
+
+
+def _as_rgb_uint8(arr):
+    """Drop the alpha channel and convert to uint8, on the array's device.
+
+    Wider dtypes are rescaled in a single pass."""
+    xp = cp.get_array_module(arr)
+    if arr.ndim == 3 and arr.shape[-1] == 4:
+        # whole-slide alpha is always opaque, drop it
+        arr = arr[..., :3]
+    if arr.dtype == np.uint8:
+        return xp.ascontiguousarray(arr)
+    out = xp.empty(arr.shape, np.uint8)
+    if np.issubdtype(arr.dtype, np.unsignedinteger):
+        # keep the most significant byte, e.g. uint16 >> 8
+        shift = (arr.dtype.itemsize - 1) * 8
+        xp.right_shift(arr, shift, out=out, casting="unsafe")
+    elif np.issubdtype(arr.dtype, np.floating):
+        xp.multiply(arr, 255, out=out, casting="unsafe")
+    else:
+        raise ValueError(f"Unsupported image dtype: {arr.dtype}")
+    return out
+
+
+def _pinned_empty(count: int) -> np.ndarray:
+    """Allocate a flat page-locked uint8 host array, so device to host
+    copies into it can run asynchronously."""
+    mem = cp.cuda.alloc_pinned_memory(count)
+    return np.frombuffer(mem, np.uint8, count)
+
+
+def _resize_tile(img: Image.Image, size: tuple[int, int]) -> Image.Image:
+    """Resize a source region to the tile size, skipping the resample when
+    the region already lands on a stored pyramid level."""
+    if img.size == size:
+        return img
+    width, height = size
+    if any(img.size == (width * f, height * f) for f in (2, 4)):
+        # exact power of two ratios lose nothing noticeable with bilinear
+        return img.resize(size, resample=Image.Resampling.BILINEAR)
+    if img.width >= width * 4 and img.height >= height * 4:
+        # box-reduce by an integer factor to within 2x of the target first,
+        # the Lanczos pass then only covers the remaining ratio
+        img = img.reduce(min(img.width // width, img.height // height) // 2)
+    return img.resize(size, resample=Image.Resampling.LANCZOS)
+
+
+class Region(NamedTuple):
+    """Level 0 bounds of a Deep Zoom tile and its size at its own level."""
+
+    left: int
+    top: int
+    right: int
+    bottom: int
+    width: int
+    height: int
+
+
+@njit(cache=True)
+def _region_bounds(
+    x: int,
+    y: int,
+    tile_size: int,
+    overlap: int,
+    lfactor: int,
+    sizeX: int,
+    sizeY: int,
+) -> tuple[int, int, int, int, int, int]:
+    """Return (left, top, right, bottom, width, height) of a tile, see
+    Region."""
+    left = (x * tile_size - overlap) * lfactor
+    top = (y * tile_size - overlap) * lfactor
+    right = ((x + 1) * tile_size + overlap) * lfactor
+    bottom = ((y + 1) * tile_size + overlap) * lfactor
+    width = height = tile_size + overlap * 2
+    # left and top are multiples of lfactor, so these divisions are exact
+    if left < 0:
+        width += left // lfactor
+        left = 0
+    if top < 0:
+        height += top // lfactor
+        top = 0
+    if left >= sizeX:
+        raise ValueError("x is outside layer")
+    if top >= sizeY:
+        raise ValueError("y is outside layer")
+    if right > sizeX:
+        right = sizeX
+        width = -((left - right) // lfactor)  # ceil division
+    if bottom > sizeY:
+        bottom = sizeY
+        height = -((top - bottom) // lfactor)
+    return left, top, right, bottom, width, height
+
+
+@functools.lru_cache(maxsize=4096)
+def _get_region(
+    x: int,
+    y: int,
+    lfactor: int,
+    sizeX: int,
+    sizeY: int,
+    tile_size: int,
+    overlap: int,
+) -> Region:
+    return Region(
+        *_region_bounds(x, y, tile_size, overlap, lfactor, sizeX, sizeY)
+    )
 
 
 # reference: https://github.com/slideflow/slideflow/blob/master/slideflow/slide/backends/cucim.py
 class DeepZoomGenerator:
+    ROW_CACHE_SIZE = 5
+    # regions spanning more source tiles than this are read directly
+    MAX_CACHED_SOURCE_TILES = 16
+    SOURCE_TILE_CACHE_SIZE = 64
+
     def __init__(
         self,
         path: Union[str, pathlib.Path],
@@ -26,12 +180,44 @@ class DeepZoomGenerator:
         self._tile_size = tile_size
         self._tile_overlap = overlap
         self._reader = CuImage(self._path)
+        # cuCIM rebuilds metadata dicts on every access, snapshot them once
+        self._metadata: dict = self._reader.metadata["cucim"]
+        self.resolutions: dict = self._metadata["resolutions"]
+        self.level_count: int = self.resolutions["level_count"]
+        self.level_dimensions: tuple[tuple[int, int], ...] = tuple(
+            map(tuple, self.resolutions["level_dimensions"])
+        )
+        self.level_downsamples: tuple[float, ...] = tuple(
+            self.resolutions["level_downsamples"]
+        )
+        self.level_tile_sizes: tuple[tuple[int, int], ...] = tuple(
+            map(tuple, self.resolutions["level_tile_sizes"])
+        )
+        self._size_x, self._size_y = self.level_dimensions[0]
+        self._row_lock = Lock()
+        # The page-locked buffers and the copy stream are set up on first
+        # GPU use: get_tile and get_dzi need no CUDA context, and slides
+        # never read on the GPU pin no host memory.
+        # reused buffer for device to host tile copies, see _cupy2image
+        self._pinned: np.ndarray | None = None
+        self._pinned_lock = Lock()
+        # the two buffers get_tiles_batch alternates between
+        self._batch_pinned: list[np.ndarray] = []
+        self._batch_lock = Lock()
+        self._row_cache: OrderedDict[
+            tuple[int, int], dict[int, Image.Image]
+        ] = OrderedDict()
+        # device arrays of decoded source tiles, by (level, sx, sy)
+        self._source_lock = Lock()
+        self._source_tiles: OrderedDict[tuple[int, int, int], cp.ndarray] = (
+            OrderedDict()
+        )
 
     @staticmethod
     def cucim2numpy(
         img: Union[CuImage, cp.ndarray, np.ndarray],
     ) -> np.ndarray:
-        """Convert a cuCIM image to a numpy array."""
+        """Convert a cuCIM image to an RGB uint8 numpy array."""
         if isinstance(img, CuImage):
             np_img = np.asarray(img)
         elif isinstance(img, np.ndarray):
@@ -41,11 +227,39 @@ class DeepZoomGenerator:
                 np_img = img.get()
             else:
                 raise ValueError(f"Unsupported image type: {type(img)}")
-        return ((img_as_float32(np_img)) * 255).astype(np.uint8)
+        return _as_rgb_uint8(np_img)
+
+    @staticmethod
+    def cucim2cupy(img: Union[CuImage, cp.ndarray]) -> cp.ndarray:
+        """Convert a device cuCIM image to an RGB uint8 cupy array.
+
+        The conversion stays on the GPU, a device CuImage is wrapped without
+        copying."""
+        return _as_rgb_uint8(cp.asarray(img))
+
+    @staticmethod
+    def _cucim_to_jpeg_gpu(
+        img: Union[CuImage, cp.ndarray], quality: int = 75
+    ) -> bytes:
+        """Encode a device cuCIM image as JPEG.
+
+        With nvImageCodec the encode runs on the GPU and only the encoded
+        bytes cross the bus, otherwise the pixels are encoded on the host."""
+        cp_img = DeepZoomGenerator.cucim2cupy(img)
+        encoder = _jpeg_encoder()
+        if encoder is None:
+            return _encode_jpeg_host(cp_img.get(), quality)
+        return bytes(
+            encoder.encode(
+                cp_img, "jpeg", params=nvimgcodec.EncodeParams(quality=quality)
+            )
+        )
 
     @staticmethod
     def numpy2image(array: np.ndarray) -> Image.Image:
-        return Image.fromarray(array).convert("RGB")
+        img = Image.fromarray(array)
+        # cucim2numpy already dropped the alpha channel
+        return img if img.mode == "RGB" else img.convert("RGB")
 
     @staticmethod
     def cucim2image(
@@ -56,9 +270,27 @@ class DeepZoomGenerator:
             DeepZoomGenerator.cucim2numpy(img)
         )
 
+    def _cupy2image(self, cp_img: cp.ndarray) -> Image.Image:
+        """Copy an RGB uint8 device array to an RGB PIL.Image through the
+        pinned host buffer."""
+        cp_img = cp.ascontiguousarray(cp_img)
+        with self._pinned_lock:
+            if self._pinned is None or self._pinned.size < cp_img.size:
+                # grown on demand
+                self._pinned = _pinned_empty(cp_img.size)
+            host = self._pinned[: cp_img.size].reshape(cp_img.shape)
+            # the copy stream doesn't sync with the null stream
+            # ascontiguousarray ran on
+            self._d2h_stream.wait_event(cp.cuda.get_current_stream().record())
+            cp.asnumpy(cp_img, stream=self._d2h_stream, out=host)
+            # PIL copies RGB pixels, the buffer is free again afterwards
+            return DeepZoomGenerator.numpy2image(host)
+
     @lazyproperty
-    def _metadata(self) -> dict:
-        return self._reader.metadata["cucim"]
+    def _d2h_stream(self) -> cp.cuda.Stream:
+        """The stream device to host copies into the pinned buffers run
+        on."""
+        return cp.cuda.Stream(non_blocking=True)
 
     def __repr__(self) -> str:
         return (
@@ -69,83 +301,65 @@ class DeepZoomGenerator:
         )
 
     @lazyproperty
-    def resolutions(self):
-        return self._metadata["resolutions"]
-
-    @lazyproperty
-    def level_count(self) -> int:
-        return self.resolutions["level_count"]
-
-    @lazyproperty
-    def level_dimensions(self):
-        return self.resolutions["level_dimensions"]
-
-    @lazyproperty
-    def level_downsamples(self):
-        return self.resolutions["level_downsamples"]
-
-    @lazyproperty
-    def level_tile_sizes(self):
-        return self.resolutions["level_tile_sizes"]
+    def dzi_level_count(self) -> int:
+        return max_dzi_level(self._size_x, self._size_y)
 
     @lazyproperty
-    def dzi_level_count(self) -> int:
-        sizeX = self.level_dimensions[0][0]
-        sizeY = self.level_dimensions[0][1]
-        return int(math.ceil(math.log(max(sizeX, sizeY)) / math.log(2)))
+    def _level_table(self) -> list[tuple[int, int, float]]:
+        """(lfactor, ds_level, ds_level_downsample) indexed by Deep Zoom
+        level."""
+        maxlevel = self.dzi_level_count
+        table = []
+        for level in range(maxlevel + 1):
+            lfactor = 1 << (maxlevel - level)
+            ds_level = self.best_level_for_downsample(lfactor)
+            table.append((lfactor, ds_level, self.level_downsamples[ds_level]))
+        return table
 
     @lazyproperty
     def associated_images(self) -> Mapping[str, Image.Image]:
-        return {
-            name: DeepZoomGenerator.cucim2image(
+        return LazyMapping(
+            self._reader.associated_images,
+            lambda name: DeepZoomGenerator.cucim2image(
                 self._reader.associated_image(name)
-            )
-            for name in self._reader.associated_images
-        }
+            ),
+        )
 
     @lazyproperty
     def mpp(self) -> float | None:
-        _mpp = None
-        # print(self._reader.metadata)
-        for prop_key in self._reader.metadata:
-            if _mpp is not None:
-                break
-            if "MPP" in self._reader.metadata[prop_key]:
-                _mpp = self._reader.metadata[prop_key]["MPP"]
-            elif "DICOM_PIXEL_SPACING" in self._reader.metadata[prop_key]:
-                ps = self._reader.metadata[prop_key]["DICOM_PIXEL_SPACING"][0]
-                _mpp = ps * 1000  # Convert from millimeters -> microns
-            elif "spacing" in self._reader.metadata[prop_key]:
-                ps = self._reader.metadata[prop_key]["spacing"]
+        # cuCIM builds the metadata dict on every access, fetch it once
+        for entry in self._reader.metadata.values():
+            if "MPP" in entry:
+                return entry["MPP"]
+            if "DICOM_PIXEL_SPACING" in entry:
+                # Convert from millimeters -> microns
+                return entry["DICOM_PIXEL_SPACING"][0] * 1000
+            if "spacing" in entry and "spacing_units" in entry:
+                ps = entry["spacing"]
                 if isinstance(ps, (list, tuple)):
                     ps = ps[0]
-                if "spacing_units" in self._reader.metadata[prop_key]:
-                    spacing_unit = self._reader.metadata[prop_key][
-                        "spacing_units"
-                    ]
-                    if isinstance(spacing_unit, (list, tuple)):
-                        spacing_unit = spacing_unit[0]
-                    if spacing_unit in ("mm", "millimeters", "millimeter"):
-                        _mpp = ps * 1000
-                    elif spacing_unit in ("cm", "centimeters", "centimeter"):
-                        _mpp = ps * 10000
-                    elif spacing_unit in (
-                        "um",
-                        "microns",
-                        "micrometers",
-                        "micrometer",
-                    ):
-                        _mpp = ps
-                    else:
-                        continue
-        return _mpp
+                spacing_unit = entry["spacing_units"]
+                if isinstance(spacing_unit, (list, tuple)):
+                    spacing_unit = spacing_unit[0]
+                if spacing_unit in ("mm", "millimeters", "millimeter"):
+                    return ps * 1000
+                if spacing_unit in ("cm", "centimeters", "centimeter"):
+                    return ps * 10000
+                if spacing_unit in (
+                    "um",
+                    "microns",
+                    "micrometers",
+                    "micrometer",
+                ):
+                    return ps
+        return None
 
     def best_level_for_downsample(
         self,
         downsample: float,
     ) -> int:
-        """Return lowest magnification level with a downsample level lower than
-        the given target.
+        """Return lowest magnification level with a downsample level not
+        higher than the given target.
 
         Args:
             downsample (float): Ratio of target resolution to resolution
@@ -155,16 +369,79 @@ class DeepZoomGenerator:
         Returns:
             int:    Optimal downsample level.
         """
-        max_downsample = 0
-        for d in self.level_downsamples:
-            if d < downsample:
-                max_downsample = d
-        try:
-            max_level = self.level_downsamples.index(max_downsample)
-        except Exception:  # pylint: disable=broad-except
-            print(f"Error attempting to read level {max_downsample}")
-            return 0
-        return max_level
+        # level_downsamples is increasing, the level matching the target
+        # exactly is read as is and needs no resampling
+        level = bisect.bisect_right(self.level_downsamples, downsample) - 1
+        return max(level, 0)
+
+    def _read_source_tile(self, level: int, sx: int, sy: int) -> cp.ndarray:
+        """Return source tile (sx, sy) of a pyramid level as an RGB uint8
+        device array, from the last SOURCE_TILE_CACHE_SIZE read."""
+        key = (level, sx, sy)
+        with self._source_lock:
+            tile = self._source_tiles.get(key)
+            if tile is not None:
+                self._source_tiles.move_to_end(key)
+                return tile
+        tile_w, tile_h = self.level_tile_sizes[level]
+        downsample = self.level_downsamples[level]
+        tile = DeepZoomGenerator.cucim2cupy(
+            self._reader.read_region(
+                location=(
+                    int(sx * tile_w * downsample),
+                    int(sy * tile_h * downsample),
+                ),
+                size=(tile_w, tile_h),
+                level=level,
+                device="cuda",
+            )
+        )
+        with self._source_lock:
+            self._source_tiles[key] = tile
+            self._source_tiles.move_to_end(key)
+            if len(self._source_tiles) > self.SOURCE_TILE_CACHE_SIZE:
+                self._source_tiles.popitem(last=False)
+        return tile
+
+    def _read_region_gpu(
+        self, location: tuple[int, int], size: tuple[int, int], level: int
+    ) -> cp.ndarray:
+        """Return a region as an RGB uint8 device array, see
+        CuImage.read_region.
+
+        The region is assembled from the cached source tiles it covers, so
+        neighbouring Deep Zoom tiles don't decode the same source tiles
+        again."""
+        tile_w, tile_h = self.level_tile_sizes[level]
+        downsample = self.level_downsamples[level]
+        x0 = int(location[0] / downsample)
+        y0 = int(location[1] / downsample)
+        width, height = size
+        tx0, ty0 = x0 // tile_w, y0 // tile_h
+        tx1 = (x0 + width - 1) // tile_w
+        ty1 = (y0 + height - 1) // tile_h
+        if (tx1 - tx0 + 1) * (ty1 - ty0 + 1) > self.MAX_CACHED_SOURCE_TILES:
+            return DeepZoomGenerator.cucim2cupy(
+                self._reader.read_region(
+                    location=location, size=size, level=level, device="cuda"
+                )
+            )
+        mosaic = cp.concatenate(
+            [
+                cp.concatenate(
+                    [
+                        self._read_source_tile(level, tx, ty)
+                        for tx in range(tx0, tx1 + 1)
+                    ],
+                    axis=1,
+                )
+                for ty in range(ty0, ty1 + 1)
+            ],
+            axis=0,
+        )
+        x0 -= tx0 * tile_w
+        y0 -= ty0 * tile_h
+        return cp.ascontiguousarray(mosaic[y0 : y0 + height, x0 : x0 + width])
 
     def get_level(self, level: int) -> Image.Image:
         """Return an RGB PIL.Image for a pyramid level."""
@@ -172,44 +449,43 @@ class DeepZoomGenerator:
             self._reader.read_region(level=level)
         )
 
-    def _get_region(
-        self, address: tuple[int, int], lfactor: int
-    ) -> tuple[dict, int, int]:
-        x, y = address
-        region = {
-            "left": (x * self._tile_size - self._tile_overlap) * lfactor,
-            "top": (y * self._tile_size - self._tile_overlap) * lfactor,
-            "right": (
-                ((x + 1) * self._tile_size + self._tile_overlap) * lfactor
-            ),
-            "bottom": (
-                ((y + 1) * self._tile_size + self._tile_overlap) * lfactor
-            ),
-        }
-        width = height = self._tile_size + self._tile_overlap * 2
-        sizeX = self.level_dimensions[0][0]
-        sizeY = self.level_dimensions[0][1]
-        if region["left"] < 0:
-            width += int(region["left"] / lfactor)
-            region["left"] = 0
-        if region["top"] < 0:
-            height += int(region["top"] / lfactor)
-            region["top"] = 0
-        if region["left"] >= sizeX:
+    def _region_bounds_vec(
+        self, xs: np.ndarray, ys: np.ndarray, lfactor: int
+    ) -> tuple[np.ndarray, ...]:
+        """Vectorised _region_bounds for arrays of tile addresses.
+
+        Returns (lefts, tops, rights, bottoms, widths, heights) as int64
+        arrays, computed with whole-array operations instead of a Python
+        loop over the tiles."""
+        span = (self._tile_size + self._tile_overlap * 2) * lfactor
+        lefts = xs.astype(np.int64) * self._tile_size - self._tile_overlap
+        lefts *= lfactor
+        tops = ys.astype(np.int64) * self._tile_size - self._tile_overlap
+        tops *= lfactor
+        if (lefts >= self._size_x).any():
             raise ValueError("x is outside layer")
-        if region["top"] >= sizeY:
+        if (tops >= self._size_y).any():
             raise ValueError("y is outside layer")
-        if region["left"] < sizeX and region["right"] > sizeX:
-            region["right"] = sizeX
-            width = int(
-                math.ceil(float(region["right"] - region["left"]) / lfactor)
-            )
-        if region["top"] < sizeY and region["bottom"] > sizeY:
-            region["bottom"] = sizeY
-            height = int(
-                math.ceil(float(region["bottom"] - region["top"]) / lfactor)
-            )
-        return region, width, height
+        rights = np.minimum(lefts + span, self._size_x)
+        bottoms = np.minimum(tops + span, self._size_y)
+        np.maximum(lefts, 0, out=lefts)
+        np.maximum(tops, 0, out=tops)
+        # ceil division, exact for unclipped bounds
+        widths = -((lefts - rights) // lfactor)
+        heights = -((tops - bottoms) // lfactor)
+        return lefts, tops, rights, bottoms, widths, heights
+
+    def _get_region(self, address: tuple[int, int], lfactor: int) -> Region:
+        x, y = address
+        return _get_region(
+            x,
+            y,
+            lfactor,
+            self._size_x,
+            self._size_y,
+            self._tile_size,
+            self._tile_overlap,
+        )
 
     def get_tile_at_z(self, z: int, xy: tuple[int, int]) -> Image.Image:
         """Return an RGB PIL.Image for a tile.
@@ -217,46 +493,282 @@ class DeepZoomGenerator:
         z:     the pyramidal level.
         xy:    the address of the tile within the level as a (col, row)
                tuple."""
-        region, _, _ = self._get_region(xy, 1)
+        region = self._get_region(xy, 1)
         return self.get_level(z).crop(
-            (
-                region["left"],
-                region["top"],
-                region["right"],
-                region["bottom"],
-            )
+            (region.left, region.top, region.right, region.bottom)
         )
 
+    def _get_tile_read(
+        self, level: int, address: tuple[int, int]
+    ) -> tuple[tuple[int, int], tuple[int, int], int, tuple[int, int]]:
+        """Return the read_region location, size and level for a tile, and
+        the size of the tile itself."""
+        if level < 1 or level > self.dzi_level_count:
+            raise ValueError("level must be between 1 and the image scale")
+        lfactor, ds_level, ds_level_downsample = self._level_table[level]
+        region = self._get_region(address, lfactor)
+        width, height = region.width, region.height
+        size = (
+            int(width * lfactor / ds_level_downsample),
+            int(height * lfactor / ds_level_downsample),
+        )
+        return (region.left, region.top), size, ds_level, (width, height)
+
     def get_tile(self, level: int, address: tuple[int, int]) -> Image.Image:
         """Return an RGB PIL.Image for a tile.
 
         level:     the Deep Zoom level.
         address:   the address of the tile within the level as a (col, row)
                    tuple."""
-        maxlevel = self.dzi_level_count
-        if level < 1 or level > maxlevel:
-            raise ValueError("level must be between 1 and the image scale")
-        lfactor = 2 ** (maxlevel - level)
-        region, width, height = self._get_region(address, lfactor)
-        top_left = (region["left"], region["top"])
-        ds_level = self.best_level_for_downsample(lfactor)
-        ds_level_downsample = self.level_downsamples[ds_level]
-        # print(lfactor, ds_level, ds_level_downsample)
-        return DeepZoomGenerator.cucim2image(
+        with self._row_lock:
+            row = self._row_cache.get((level, address[1]))
+            if row is not None and address[0] in row:
+                return row[address[0]].copy()
+        top_left, size, ds_level, tile_size = self._get_tile_read(
+            level, address
+        )
+        # read on the host, so serving tiles needs no CUDA context; the GPU
+        # paths assemble regions from the cached source tiles instead
+        return _resize_tile(
+            DeepZoomGenerator.cucim2image(
+                self._reader.read_region(
+                    location=top_left, size=size, level=ds_level
+                )
+            ),
+            tile_size,
+        )
+
+    def get_tile_array(
+        self, level: int, address: tuple[int, int]
+    ) -> cp.ndarray:
+        """Return an RGB uint8 cupy array for a tile, kept on the GPU.
+
+        The array exposes __cuda_array_interface__ and DLPack, so array
+        consumers never round-trip through host memory.
+
+        level:     the Deep Zoom level.
+        address:   the address of the tile within the level as a (col, row)
+                   tuple."""
+        top_left, size, ds_level, (width, height) = self._get_tile_read(
+            level, address
+        )
+        cp_img = self._read_region_gpu(top_left, size, ds_level)
+        if cp_img.shape[:2] != (height, width):
+            cp_img = cu_resize(
+                cp_img,
+                (height, width, cp_img.shape[2]),
+                order=3,
+                preserve_range=True,
+                anti_aliasing=True,
+            ).astype(cp.uint8)
+        return cp_img
+
+    def get_tile_jpeg(
+        self, level: int, address: tuple[int, int], quality: int = 75
+    ) -> bytes:
+        """Return a tile encoded as JPEG bytes, skipping the PIL.Image that
+        get_tile would build.
+
+        The tile is read and encoded on the GPU when nvImageCodec is
+        available, otherwise it stays a numpy array for libjpeg-turbo.
+
+        level:     the Deep Zoom level.
+        address:   the address of the tile within the level as a (col, row)
+                   tuple."""
+        if _jpeg_encoder() is not None:
+            return DeepZoomGenerator._cucim_to_jpeg_gpu(
+                self.get_tile_array(level, address), quality
+            )
+        top_left, size, ds_level, tile_size = self._get_tile_read(
+            level, address
+        )
+        array = DeepZoomGenerator.cucim2numpy(
             self._reader.read_region(
-                location=top_left,
-                size=(
-                    int(width * lfactor / ds_level_downsample),
-                    int(height * lfactor / ds_level_downsample),
-                ),
-                level=ds_level,
+                location=top_left, size=size, level=ds_level
+            )
+        )
+        if size != tile_size:
+            array = np.asarray(
+                _resize_tile(DeepZoomGenerator.numpy2image(array), tile_size)
             )
-        ).resize((width, height), resample=Image.Resampling.LANCZOS)
+        return _encode_jpeg_host(array, quality)
+
+    def level_tiles(self, level: int) -> tuple[int, int]:
+        """Return the number of (columns, rows) of tiles in a Deep Zoom
+        level."""
+        lfactor = self._level_table[level][0]
+        # ceil divisions
+        width = -(-self._size_x // lfactor)
+        height = -(-self._size_y // lfactor)
+        return (
+            -(-width // self._tile_size),
+            -(-height // self._tile_size),
+        )
+
+    def iter_tiles(self, level: int) -> Iterator[tuple[int, int]]:
+        """Yield the (col, row) addresses of every tile in a Deep Zoom level
+        in Morton order, to keep the reader's tile cache warm when
+        generating a whole level."""
+        yield from morton_order(*self.level_tiles(level))
+
+    def get_tile_row(
+        self, level: int, y: int, x_range: range
+    ) -> list[Image.Image]:
+        """Return RGB PIL.Images for a run of tiles in one row of a Deep Zoom
+        level, read from the source with a single read_region call.
+
+        The tiles are also kept in a small row cache that get_tile serves
+        copies from, so a viewer walking the row hits memory.
+
+        level:     the Deep Zoom level.
+        y:         the row of the tiles within the level.
+        x_range:   the columns of the tiles within the level."""
+        if level < 1 or level > self.dzi_level_count:
+            raise ValueError("level must be between 1 and the image scale")
+        if not x_range:
+            return []
+        lfactor, ds_level, ds_level_downsample = self._level_table[level]
+        xs = np.asarray(x_range, np.int64)
+        regions = [
+            Region(*bounds)
+            for bounds in zip(
+                *(
+                    a.tolist()
+                    for a in self._region_bounds_vec(
+                        xs, np.full_like(xs, y), lfactor
+                    )
+                )
+            )
+        ]
+        left, top = regions[0].left, regions[0].top
+        strip = self._read_region_gpu(
+            (left, top),
+            (
+                int((regions[-1].right - left) / ds_level_downsample),
+                int((regions[0].bottom - top) / ds_level_downsample),
+            ),
+            ds_level,
+        )
+        tiles = []
+        for region in regions:
+            x0 = int((region.left - left) / ds_level_downsample)
+            x1 = x0 + int(region.width * lfactor / ds_level_downsample)
+            y1 = int(region.height * lfactor / ds_level_downsample)
+            tiles.append(
+                _resize_tile(
+                    self._cupy2image(strip[:y1, x0:x1]),
+                    (region.width, region.height),
+                )
+            )
+        with self._row_lock:
+            row = self._row_cache.pop((level, y), {})
+            row.update(zip(x_range, tiles))
+            self._row_cache[(level, y)] = row
+            if len(self._row_cache) > self.ROW_CACHE_SIZE:
+                self._row_cache.popitem(last=False)
+        # callers may transform tiles in place, keep the cached ones intact
+        return [tile.copy() for tile in tiles]
+
+    @lazyproperty
+    def _encode_pool(self) -> ThreadPoolExecutor:
+        return ThreadPoolExecutor(max_workers=2)
+
+    def get_tiles_batch(
+        self, level: int, addresses: Sequence[tuple[int, int]]
+    ) -> list[Image.Image]:
+        """Return RGB PIL.Images for several tiles of a Deep Zoom level.
+
+        Regions are read on the GPU and copied back on their own stream into
+        two pinned host buffers, while the previous tile is resampled on a
+        worker thread.  Single tiles go through get_tile to keep latency.
+
+        level:     the Deep Zoom level.
+        addresses: the addresses of the tiles within the level as (col, row)
+                   tuples."""
+        if len(addresses) < 2:
+            return [self.get_tile(level, address) for address in addresses]
+        if level < 1 or level > self.dzi_level_count:
+            raise ValueError("level must be between 1 and the image scale")
+        lfactor, ds_level, ds_level_downsample = self._level_table[level]
+        xs, ys = np.asarray(addresses, np.int64).T
+        lefts, tops, _, _, widths, heights = self._region_bounds_vec(
+            xs, ys, lfactor
+        )
+        read_ws = (widths * lfactor / ds_level_downsample).astype(np.int64)
+        read_hs = (heights * lfactor / ds_level_downsample).astype(np.int64)
+        reads = [
+            ((left, top), (read_w, read_h), ds_level, (width, height))
+            for left, top, read_w, read_h, width, height in zip(
+                lefts.tolist(),
+                tops.tolist(),
+                read_ws.tolist(),
+                read_hs.tolist(),
+                widths.tolist(),
+                heights.tolist(),
+            )
+        ]
+        count = int((read_ws * read_hs).max()) * 3
+        with self._batch_lock:
+            if not self._batch_pinned or self._batch_pinned[0].size < count:
+                self._batch_pinned = [_pinned_empty(count) for _ in range(2)]
+            return self._copy_tiles_batch(reads, self._batch_pinned)
+
+    def _copy_tiles_batch(
+        self,
+        reads: list[tuple],
+        host_bufs: list[np.ndarray],
+    ) -> list[Image.Image]:
+        """Read the regions and copy them back through the two pinned
+        `host_bufs`, see get_tiles_batch."""
+        # keep each device image alive until its async copy is done
+        device_imgs: list[cp.ndarray | None] = [None, None]
+        pending: list[Future | None] = [None, None]
+        stream = self._d2h_stream
+
+        def finish(
+            host: np.ndarray,
+            event: cp.cuda.Event,
+            tile_size: tuple[int, int],
+        ) -> Image.Image:
+            event.synchronize()
+            return _resize_tile(DeepZoomGenerator.numpy2image(host), tile_size)
+
+        futures = []
+        for i, (top_left, size, ds_level, tile_size) in enumerate(reads):
+            slot = i % 2
+            if pending[slot] is not None:
+                # wait until the encode of tile i-2 released this buffer
+                pending[slot].result()
+            cp_img = device_imgs[slot] = self._read_region_gpu(
+                top_left, size, ds_level
+            )
+            host = host_bufs[slot][: cp_img.size].reshape(cp_img.shape)
+            # the copy stream doesn't sync with the null stream the region
+            # was assembled on
+            stream.wait_event(cp.cuda.get_current_stream().record())
+            with stream:
+                cp_img.get(stream=stream, out=host, blocking=False)
+                event = stream.record()
+            pending[slot] = self._encode_pool.submit(
+                finish, host, event, tile_size
+            )
+            futures.append(pending[slot])
+        return [future.result() for future in futures]
 
     def get_dzi(
         self, _format: str = "jpeg"  # pylint: disable=unused-variable
     ) -> str:
         """Return a string containing the XML metadata for the .dzi file."""
+        return self._dzi
+
+    @lazyproperty
+    def dzi_bytes(self) -> bytes:
+        """The .dzi XML metadata, UTF-8 encoded for an HTTP response."""
+        return self._dzi.encode("UTF-8")
+
+    @lazyproperty
+    def _dzi(self) -> str:
+        # only depends on immutable metadata, so it is built once
         image = Element(
             "Image",
             TileSize=str(self._tile_size),
@@ -264,13 +776,11 @@ class DeepZoomGenerator:
             Format="jpeg",
             xmlns="http://schemas.microsoft.com/deepzoom/2008",
         )
-        sizeX = self.level_dimensions[0][0]
-        sizeY = self.level_dimensions[0][1]
         SubElement(
             image,
             "Size",
-            Width=str(sizeX),
-            Height=str(sizeY),
+            Width=str(self._size_x),
+            Height=str(self._size_y),
         )
         tree = ElementTree(element=image)
         buf = BytesIO()
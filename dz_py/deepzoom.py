@@ -1,14 +1,54 @@
-import math
 import pathlib
-from collections.abc import Mapping
+from collections.abc import Iterable, Mapping
 from io import BytesIO
 from typing import Union
 from xml.etree.ElementTree import Element, ElementTree, SubElement
 
 import large_image
+import numpy as np
 from PIL import Image, ImageCms
 
-from .util import lazyproperty
+from .util import LazyMapping, lazyproperty, max_dzi_level
+
+
+def _as_rgb(img: Image.Image) -> Image.Image:
+    """Return img in RGB mode, without a copy when it already is."""
+    if img.mode == "RGB":
+        return img
+    return img.convert("RGB")
+
+
+def _region_output_size(
+    width: int, height: int, region_width: int, region_height: int
+) -> tuple[int, int]:
+    """Return the size getRegion scales a region_width x region_height
+    region to, for maxWidth=width and maxHeight=height: it keeps the aspect
+    ratio, and can round one side down.
+
+    Mirrors _calculateWidthHeight in large_image.tilesource.utilities, which
+    is private; the float arithmetic has to match it exactly."""
+    if region_width == 0 or region_height == 0:
+        return 0, 0
+    scaled_width = max(1, int(region_width * float(height) / region_height))
+    scaled_height = max(1, int(region_height * float(width) / region_width))
+    if scaled_width == width or (
+        float(width) * region_height > float(height) * region_width
+        and scaled_height != height
+    ):
+        return scaled_width, height
+    return width, scaled_height
+
+
+def _own_tile(tile: Image.Image | np.ndarray | bytes) -> Image.Image:
+    """Return a getTile result as a PIL.Image the caller may modify.
+
+    getTile hands back the object in large_image's tile cache, or the
+    stored image file bytes."""
+    if isinstance(tile, Image.Image):
+        return tile.copy()
+    if isinstance(tile, np.ndarray):
+        return Image.fromarray(tile.copy())
+    return Image.open(BytesIO(tile))
 
 
 class DeepZoomGenerator:
@@ -46,18 +86,53 @@ class DeepZoomGenerator:
             f"overlap={self._tile_overlap})"
         )
 
+    @lazyproperty
+    def _size_x(self) -> int:
+        return self._metadata["sizeX"]
+
+    @lazyproperty
+    def _size_y(self) -> int:
+        return self._metadata["sizeY"]
+
     @lazyproperty
     def level_count(self) -> int:
         return self._metadata["levels"]
 
+    @lazyproperty
+    def _native_tile_size(self) -> int | None:
+        # stored tiles are square in every format large_image handles, but
+        # don't take it for granted
+        width = self._metadata.get("tileWidth")
+        return width if width == self._metadata.get("tileHeight") else None
+
+    @lazyproperty
+    def _max_level(self) -> int:
+        return max_dzi_level(self._size_x, self._size_y)
+
+    @lazyproperty
+    def _tile_span(self) -> int:
+        return self._tile_size + self._tile_overlap * 2
+
     @lazyproperty
     def dzi_level_count(self) -> int:
-        return int(
-            math.ceil(
-                math.log(max(self._metadata["sizeX"], self._metadata["sizeY"]))
-                / math.log(2)
+        return self._max_level
+
+    @lazyproperty
+    def level_tiles(self) -> tuple[tuple[int, int], ...]:
+        """(columns, rows) of tiles for each Deep Zoom level, indexed like
+        openslide's DeepZoomGenerator.level_tiles."""
+        tiles = []
+        for level in range(self._max_level + 1):
+            lfactor = 1 << (self._max_level - level)
+            width = -(-self._size_x // lfactor)
+            height = -(-self._size_y // lfactor)
+            tiles.append(
+                (
+                    -(-width // self._tile_size),
+                    -(-height // self._tile_size),
+                )
             )
-        )
+        return tuple(tiles)
 
     @lazyproperty
     def get_icc_profile(self) -> ImageCms.ImageCmsProfile | None:
@@ -81,16 +156,11 @@ class DeepZoomGenerator:
 
     @lazyproperty
     def associated_images(self) -> Mapping[str, Image.Image]:
-        associated_images_list = self._tile_source.getAssociatedImagesList()
-        if len(associated_images_list) == 0:
-            return {}
-        else:
-            return {
-                # pylint: disable=protected-access
-                name: self._tile_source._getAssociatedImage(name)
-                for name in associated_images_list
-                if self._tile_source._getAssociatedImage(name)
-            }
+        return LazyMapping(
+            self._tile_source.getAssociatedImagesList(),
+            # pylint: disable=protected-access
+            self._tile_source._getAssociatedImage,
+        )
 
     @lazyproperty
     def _mpp(self) -> float | None:
@@ -110,7 +180,9 @@ class DeepZoomGenerator:
         z:     the pyramidal level.
         xy:    the address of the tile within the level as a (col, row)
                tuple."""
-        return self._tile_source.getTile(xy[0], xy[1], z, True).convert("RGB")
+        return _as_rgb(
+            _own_tile(self._tile_source.getTile(xy[0], xy[1], z, True))
+        )
 
     def get_tile(self, level: int, address: tuple[int, int]) -> Image.Image:
         """Return an RGB PIL.Image for a tile.
@@ -119,65 +191,162 @@ class DeepZoomGenerator:
         address:   the address of the tile within the level as a (col, row)
                    tuple."""
         # https://github.com/girder/large_image/blob/master/girder/girder_large_image/rest/tiles.py#L645
-        maxlevel = int(
-            math.ceil(
-                math.log(max(self._metadata["sizeX"], self._metadata["sizeY"]))
-                / math.log(2)
-            )
-        )
+        maxlevel = self._max_level
         if level < 1 or level > maxlevel:
             raise ValueError("level must be between 1 and the image scale")
-        lfactor = 2 ** (maxlevel - level)
+        sx = self._size_x
+        sy = self._size_y
+        ts = self._tile_size
+        ov = self._tile_overlap
+        lfactor = 1 << (maxlevel - level)
         x, y = address
-        region = {
-            "left": (x * self._tile_size - self._tile_overlap) * lfactor,
-            "top": (y * self._tile_size - self._tile_overlap) * lfactor,
-            "right": (
-                ((x + 1) * self._tile_size + self._tile_overlap) * lfactor
-            ),
-            "bottom": (
-                ((y + 1) * self._tile_size + self._tile_overlap) * lfactor
-            ),
-        }
-        width = height = self._tile_size + self._tile_overlap * 2
-        if region["left"] < 0:
-            width += int(region["left"] / lfactor)
-            region["left"] = 0
-        if region["top"] < 0:
-            height += int(region["top"] / lfactor)
-            region["top"] = 0
-        if region["left"] >= self._metadata["sizeX"]:
+        left = (x * ts - ov) * lfactor
+        top = (y * ts - ov) * lfactor
+        right = ((x + 1) * ts + ov) * lfactor
+        bottom = ((y + 1) * ts + ov) * lfactor
+        width = height = self._tile_span
+        # left and top are multiples of lfactor, so these divisions are exact
+        if left < 0:
+            width += left // lfactor
+            left = 0
+        if top < 0:
+            height += top // lfactor
+            top = 0
+        if left >= sx:
             raise ValueError("x is outside layer")
-        if region["top"] >= self._metadata["sizeY"]:
+        if top >= sy:
             raise ValueError("y is outside layer")
         if (
-            region["left"] < self._metadata["sizeX"]
-            and region["right"] > self._metadata["sizeX"]
+            lfactor == 1
+            and ov == 0
+            and ts == self._native_tile_size
+            and right <= sx
+            and bottom <= sy
         ):
-            region["right"] = self._metadata["sizeX"]
-            width = int(
-                math.ceil(float(region["right"] - region["left"]) / lfactor)
-            )
-        if (
-            region["top"] < self._metadata["sizeY"]
-            and region["bottom"] > self._metadata["sizeY"]
-        ):
-            region["bottom"] = self._metadata["sizeY"]
-            height = int(
-                math.ceil(float(region["bottom"] - region["top"]) / lfactor)
+            # exactly one stored full-resolution tile, skip the region
+            # crop and resample
+            return _as_rgb(
+                _own_tile(
+                    self._tile_source.getTile(x, y, self.level_count - 1, True)
+                )
             )
+        if right > sx:
+            right = sx
+            width = -((left - right) // lfactor)  # ceil division
+        if bottom > sy:
+            bottom = sy
+            height = -((top - bottom) // lfactor)
+        region = {"left": left, "top": top, "right": right, "bottom": bottom}
         region_data, _ = self._tile_source.getRegion(
             region=region,
             output=dict(maxWidth=width, maxHeight=height),
             format=large_image.tilesource.TILE_FORMAT_PIL,
             jpegQuality=100,
         )
-        return region_data.convert("RGB")
+        return _as_rgb(region_data)
+
+    def get_tiles(
+        self, level: int, addresses: Iterable[tuple[int, int]]
+    ) -> dict[tuple[int, int], Image.Image]:
+        """Return RGB PIL.Images for several tiles of one level, read with a
+        single getRegion over their bounding box.
+
+        level:       the Deep Zoom level.
+        addresses:   the addresses of the tiles within the level as
+                     (col, row) tuples."""
+        maxlevel = self._max_level
+        if level < 1 or level > maxlevel:
+            raise ValueError("level must be between 1 and the image scale")
+        ts = self._tile_size
+        ov = self._tile_overlap
+        lfactor = 1 << (maxlevel - level)
+        # size of the level, in its own pixels
+        level_width = -(-self._size_x // lfactor)
+        level_height = -(-self._size_y // lfactor)
+        tiles = {}
+        boxes = {}
+        for x, y in addresses:
+            left = max(0, x * ts - ov)
+            top = max(0, y * ts - ov)
+            if left >= level_width:
+                raise ValueError("x is outside layer")
+            if top >= level_height:
+                raise ValueError("y is outside layer")
+            box = (
+                left,
+                top,
+                min(level_width, (x + 1) * ts + ov),
+                min(level_height, (y + 1) * ts + ov),
+            )
+            if self._region_fits(box, lfactor):
+                boxes[(x, y)] = box
+            else:
+                # get_tile gets this one rounded a pixel short, a crop of
+                # the shared region wouldn't match it
+                tiles[(x, y)] = self.get_tile(level, (x, y))
+        if not boxes:
+            return tiles
+        left = min(box[0] for box in boxes.values())
+        top = min(box[1] for box in boxes.values())
+        right = max(box[2] for box in boxes.values())
+        bottom = max(box[3] for box in boxes.values())
+        if not self._region_fits((left, top, right, bottom), lfactor):
+            tiles.update(
+                (address, self.get_tile(level, address)) for address in boxes
+            )
+            return tiles
+        region = {
+            "left": left * lfactor,
+            "top": top * lfactor,
+            "right": min(self._size_x, right * lfactor),
+            "bottom": min(self._size_y, bottom * lfactor),
+        }
+        region_data, _ = self._tile_source.getRegion(
+            region=region,
+            output=dict(maxWidth=right - left, maxHeight=bottom - top),
+            format=large_image.tilesource.TILE_FORMAT_PIL,
+            jpegQuality=100,
+        )
+        region_data = _as_rgb(region_data)
+        for address, box in boxes.items():
+            tiles[address] = region_data.crop(
+                (
+                    box[0] - left,
+                    box[1] - top,
+                    box[2] - left,
+                    box[3] - top,
+                )
+            )
+        return tiles
+
+    def _region_fits(
+        self, box: tuple[int, int, int, int], lfactor: int
+    ) -> bool:
+        """Whether getRegion scales `box`, in level pixels, to exactly its
+        size: it keeps the aspect ratio, and can round one side down."""
+        left, top, right, bottom = box
+        width, height = _region_output_size(
+            right - left,
+            bottom - top,
+            min(self._size_x, right * lfactor) - left * lfactor,
+            min(self._size_y, bottom * lfactor) - top * lfactor,
+        )
+        return (width, height) == (right - left, bottom - top)
 
     def get_dzi(
         self, _format: str = "jpeg"  # pylint: disable=unused-variable
     ) -> str:
         """Return a string containing the XML metadata for the .dzi file."""
+        return self._dzi
+
+    @lazyproperty
+    def dzi_bytes(self) -> bytes:
+        """The .dzi XML metadata, UTF-8 encoded for an HTTP response."""
+        return self._dzi.encode("UTF-8")
+
+    @lazyproperty
+    def _dzi(self) -> str:
+        # only depends on immutable metadata, so it is built once
         image = Element(
             "Image",
             TileSize=str(self._tile_size),
@@ -188,8 +357,8 @@ class DeepZoomGenerator:
         SubElement(
             image,
             "Size",
-            Width=str(self._metadata["sizeX"]),
-            Height=str(self._metadata["sizeY"]),
+            Width=str(self._size_x),
+            Height=str(self._size_y),
         )
         tree = ElementTree(element=image)
         buf = BytesIO()
@@ -206,7 +375,7 @@ class DeepZoomGenerator:
         )
         if thumbnail is None:
             raise ValueError("No thumbnail available for this image")
-        return thumbnail.convert("RGB")
+        return _as_rgb(thumbnail)
 
     @classmethod
     def can_read(cls, path: Union[str, pathlib.Path]) -> bool:
@@ -1,4 +1,6 @@
 import functools
+import itertools
+from collections.abc import Iterable, Iterator, Mapping
 from typing import Any, Callable
 
 
@@ -50,3 +52,67 @@ def lazyproperty(f: Callable[..., Any]):
     """
     # pylint: disable=unused-variable
     return property(functools.lru_cache(maxsize=100)(f))
+
+
+class LazyMapping(Mapping):
+    """Read-only mapping whose values are loaded on first access.
+
+    The keys are known up front; `loader(key)` is called the first time a
+    key is looked up and its result is kept for later lookups.
+    """
+
+    def __init__(self, keys: Iterable[str], loader: Callable[[str], Any]):
+        # ordered for iteration, and a set for lookups
+        self._keys = tuple(keys)
+        self._key_set = frozenset(self._keys)
+        self._loader = loader
+        self._values: dict[str, Any] = {}
+
+    def __contains__(self, key: object) -> bool:
+        # Mapping's default looks the value up, which would load it
+        return key in self._key_set
+
+    def __getitem__(self, key: str) -> Any:
+        if key not in self._values:
+            if key not in self._key_set:
+                raise KeyError(key)
+            self._values[key] = self._loader(key)
+        return self._values[key]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._keys)
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+
+def max_dzi_level(width: int, height: int) -> int:
+    """Return the highest Deep Zoom level of a width x height image,
+    ceil(log2(max(width, height))), exactly in integers.
+
+    Floating point log2 can land just below an integer for powers of two
+    and round to the wrong level."""
+    return (max(width, height) - 1).bit_length()
+
+
+def _morton_code(xy: tuple[int, int]) -> int:
+    """Interleave the bits of (x, y) into a Z-order curve index."""
+    x, y = xy
+    code = 0
+    for bit in range(max(x, y).bit_length()):
+        code |= ((x >> bit) & 1) << (2 * bit)
+        code |= ((y >> bit) & 1) << (2 * bit + 1)
+    return code
+
+
+@functools.lru_cache(maxsize=32)
+def morton_order(nx: int, ny: int) -> tuple[tuple[int, int], ...]:
+    """Return all (x, y) addresses of an nx by ny grid in Morton (Z) order.
+
+    Neighbouring addresses stay close together in the sequence, so reading
+    tiles in this order keeps the source tile cache warm where raster order
+    would evict it on every wide row.
+    """
+    return tuple(
+        sorted(itertools.product(range(nx), range(ny)), key=_morton_code)
+    )
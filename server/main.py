@@ -1,30 +1,44 @@
 import base64
+import functools
+import hashlib
+import multiprocessing
 import os
 import sys
+import tempfile
+import time
 import zlib
 from argparse import ArgumentParser
 from collections import OrderedDict
-from collections.abc import Callable
+from collections.abc import Callable, Mapping
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 from io import BytesIO
 from pathlib import Path, PurePath
 from threading import Lock
 from typing import Any, Literal, TypeAlias
 
+import large_image
+import numpy as np
 import uvicorn
 import yaml
 from fastapi import FastAPI, HTTPException, Request, Response
-from fastapi.responses import HTMLResponse
+from fastapi.responses import FileResponse, HTMLResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from PIL import Image, ImageCms
 from pydantic_settings import BaseSettings
 
+try:
+    from turbojpeg import TJPF_RGB, TJSAMP_420, TurboJPEG
+
+    _TJ: TurboJPEG | None = TurboJPEG()
+except (ImportError, OSError, RuntimeError):
+    # PyTurboJPEG or the libturbojpeg library is missing, Pillow encodes
+    _TJ = None
+
 sys.path.insert(0, os.path.abspath(Path(__file__).parent.parent.absolute()))
 # pylint: disable=wrong-import-position
-from openslide import ImageSlide
-from openslide.deepzoom import DeepZoomGenerator as DeepZoomGeneratorOSD
-
 from dz_py.deepzoom import DeepZoomGenerator
+from dz_py.util import lazyproperty
 
 SRGB_PROFILE_BYTES = zlib.decompress(
     base64.b64decode(
@@ -38,6 +52,23 @@ SRGB_PROFILE_BYTES = zlib.decompress(
     )
 )
 SRGB_PROFILE = ImageCms.getOpenProfile(BytesIO(SRGB_PROFILE_BYTES))
+SRGB_PROFILE_DESCRIPTIONS = {
+    ImageCms.getProfileDescription(SRGB_PROFILE).strip(),
+    "sRGB IEC61966-2.1",
+}
+# compiled transforms, shared by slides from scanners with the same
+# profile, least recently used first
+_TRANSFORMS: OrderedDict[
+    tuple[bytes, ImageCms.Intent], ImageCms.ImageCmsTransform
+] = OrderedDict()
+_TRANSFORMS_SIZE = 32
+_TRANSFORMS_LOCK = Lock()
+# payload of one APP2 segment: 65535 minus the length field and the
+# "ICC_PROFILE\0" + sequence number + count header
+_ICC_CHUNK_SIZE = 65535 - 2 - 14
+_NEIGHBOURS = tuple(
+    (dc, dr) for dr in (-1, 0, 1) for dc in (-1, 0, 1) if dc or dr
+)
 ColorMode: TypeAlias = Literal[
     "default",
     "absolute-colorimetric",
@@ -50,80 +81,408 @@ ColorMode: TypeAlias = Literal[
 Transform: TypeAlias = Callable[[Image.Image], None]
 
 
+def _profile_digest(profile_bytes: bytes) -> bytes:
+    return hashlib.blake2b(profile_bytes, digest_size=16).digest()
+
+
+def _icc_app2_segments(icc_profile: bytes) -> bytes:
+    """Return the JPEG APP2 marker segments embedding an ICC profile."""
+    chunks = [
+        icc_profile[i : i + _ICC_CHUNK_SIZE]
+        for i in range(0, len(icc_profile), _ICC_CHUNK_SIZE)
+    ]
+    return b"".join(
+        b"\xff\xe2"
+        + (2 + 14 + len(chunk)).to_bytes(2, "big")
+        + b"ICC_PROFILE\0"
+        + bytes((seq, len(chunks)))
+        + chunk
+        for seq, chunk in enumerate(chunks, 1)
+    )
+
+
+# nearly every tile embeds sRGB, see _SlideCache._get_transform
+_SRGB_APP2_SEGMENTS = _icc_app2_segments(SRGB_PROFILE_BYTES)
+
+
+def _embed_icc(data: bytes, icc_profile: bytes) -> bytes:
+    """Splice an ICC profile into encoded JPEG bytes."""
+    segments = (
+        _SRGB_APP2_SEGMENTS
+        if icc_profile == SRGB_PROFILE_BYTES
+        else _icc_app2_segments(icc_profile)
+    )
+    # after SOI, and after the JFIF APP0 segment which has to come first
+    pos = 2
+    if data[2:4] == b"\xff\xe0":
+        pos = 4 + int.from_bytes(data[4:6], "big")
+    return data[:pos] + segments + data[pos:]
+
+
+def _encode_jpeg(
+    tile: Image.Image | np.ndarray,
+    quality: int,
+    icc_profile: bytes | None = None,
+) -> bytes:
+    """Encode an RGB tile as JPEG, with libjpeg-turbo's SIMD encoder when
+    PyTurboJPEG is available.  The ICC profile is spliced in afterwards,
+    rather than chunked by the encoder.
+
+    An (height, width, 3) uint8 array goes to libjpeg-turbo without a
+    copy."""
+    if _TJ is None:
+        if isinstance(tile, np.ndarray):
+            tile = Image.fromarray(tile)
+        buf = BytesIO()
+        tile.save(
+            buf,
+            "jpeg",
+            quality=quality,
+            # 4:2:0, and no optimize pass or progressive scans: both make
+            # libjpeg scan the image again, and the optimize pass disables
+            # the SIMD Huffman encoder on some libjpeg-turbo builds
+            subsampling=2,
+            optimize=False,
+            progressive=False,
+        )
+        data = buf.getvalue()
+    else:
+        data = _TJ.encode(
+            np.asarray(tile),
+            quality=quality,
+            pixel_format=TJPF_RGB,
+            jpeg_subsample=TJSAMP_420,
+        )
+    if icc_profile:
+        data = _embed_icc(data, icc_profile)
+    return data
+
+
+# Transforms are module-level functions or _ColorTransform instances, so
+# they pickle and can be applied in the encoder processes.
+def _no_transform(_img: Image.Image) -> None:
+    pass
+
+
+def _drop_icc(img: Image.Image) -> None:
+    img.info.pop("icc_profile", None)
+
+
+def _embed_srgb(img: Image.Image) -> None:
+    img.info["icc_profile"] = SRGB_PROFILE_BYTES
+
+
+class _UnknownProfileError(LookupError):
+    """An encoder process has no compiled transform for a profile yet."""
+
+
+class _ColorTransform:
+    """Convert tiles from a slide's ICC profile to sRGB.
+
+    Pickles as the profile digest and intent only.  Each process keeps the
+    compiled transforms of the most recent profiles in _TRANSFORMS; an
+    encoder process that hasn't seen the profile, or has dropped it,
+    raises _UnknownProfileError, and is sent the profile with the next
+    call, see _transform_and_encode."""
+
+    def __init__(
+        self,
+        profile_bytes: bytes | None,
+        intent: ImageCms.Intent,
+        digest: bytes | None = None,
+    ):
+        self.profile_bytes = profile_bytes
+        self.intent = intent
+        self._key = (
+            _profile_digest(profile_bytes) if digest is None else digest,
+            intent,
+        )
+
+    def __reduce__(self):
+        return (type(self), (None, self.intent, self._key[0]))
+
+    def __eq__(self, other: object) -> bool:
+        return isinstance(other, _ColorTransform) and self._key == other._key
+
+    def __hash__(self) -> int:
+        return hash(self._key)
+
+    def __call__(self, img: Image.Image) -> None:
+        with _TRANSFORMS_LOCK:
+            transform = _TRANSFORMS.get(self._key)
+            if transform is not None:
+                _TRANSFORMS.move_to_end(self._key)
+        if transform is None:
+            if self.profile_bytes is None:
+                raise _UnknownProfileError(self._key)
+            transform = self.build(self.profile_bytes)
+        ImageCms.applyTransform(img, transform, inPlace=True)
+        # Some browsers assume we intend the display's color space if we
+        # don't embed the profile.  Pillow's serialization is larger, so
+        # use ours.
+        img.info["icc_profile"] = SRGB_PROFILE_BYTES
+
+    def build(self, profile_bytes: bytes) -> ImageCms.ImageCmsTransform:
+        # no HIGHRESPRECALC, the smaller LUT suits 254x254 tiles
+        transform = ImageCms.buildTransform(
+            ImageCms.ImageCmsProfile(BytesIO(profile_bytes)),
+            SRGB_PROFILE,
+            "RGB",
+            "RGB",
+            self.intent,
+            ImageCms.Flags.NONE,
+        )
+        with _TRANSFORMS_LOCK:
+            transform = _TRANSFORMS.setdefault(self._key, transform)
+            if len(_TRANSFORMS) > _TRANSFORMS_SIZE:
+                _TRANSFORMS.popitem(last=False)
+        return transform
+
+
+def _transform_and_encode(
+    array: np.ndarray,
+    icc_profile: bytes | None,
+    transform: Transform,
+    quality: int,
+    profile_bytes: bytes | None = None,
+) -> bytes:
+    """Color-convert and encode a tile, in an encoder process.
+
+    `profile_bytes` registers the transform's profile with this process,
+    after it raised _UnknownProfileError."""
+    converts = isinstance(transform, _ColorTransform)
+    if converts and profile_bytes is not None:
+        transform.build(profile_bytes)
+    if converts:
+        # LittleCMS works on Pillow images only
+        tile = Image.fromarray(array)
+    else:
+        # the other transforms only touch the embedded profile, run them on
+        # an empty image and encode the array as it is
+        tile = Image.new("RGB", (0, 0))
+    if icc_profile:
+        tile.info["icc_profile"] = icc_profile
+    transform(tile)
+    return _encode_jpeg(
+        tile if converts else array,
+        quality,
+        tile.info.get("icc_profile"),
+    )
+
+
+# most tiles queued for prefetching, see create_app's submit_prefetch
+_PREFETCH_QUEUE_SIZE = 64
+# most levels below the single-tile ones a warm request may ask for, the
+# tile budget still applies
+_MAX_WARM_LEVELS = 8
+
+
+def _top_levels(slide: DeepZoomGenerator, levels: int) -> range:
+    """Return the Deep Zoom levels at the top of the pyramid: every level
+    that fits in a single tile, plus the next `levels` levels below."""
+    level_tiles = slide.level_tiles
+    first = next(
+        (
+            level
+            for level, (cols, rows) in enumerate(level_tiles)
+            if cols * rows > 1
+        ),
+        len(level_tiles),
+    )
+    return range(1, min(first + levels, len(level_tiles)))
+
+
 class AnnotatedDeepZoomGenerator(DeepZoomGenerator):
     filename: str
     mpp: float
     transform: Transform
 
 
-class AnnotatedDeepZoomGeneratorOSD(DeepZoomGeneratorOSD):
-    filename: str
-    mpp: float
-    transform: Transform
+@functools.cache
+def _get_osd() -> tuple[type, type]:
+    """Import openslide on first use, only associated images need it, and
+    return ImageSlide and AnnotatedDeepZoomGeneratorOSD."""
+    # pylint: disable=import-outside-toplevel
+    from openslide import ImageSlide
+    from openslide.deepzoom import DeepZoomGenerator as DeepZoomGeneratorOSD
+
+    class AnnotatedDeepZoomGeneratorOSD(DeepZoomGeneratorOSD):
+        filename: str
+        mpp: float
+        transform: Transform
+
+        @lazyproperty
+        def dzi_bytes(self) -> bytes:
+            return self.get_dzi("jpeg").encode("UTF-8")
+
+    return ImageSlide, AnnotatedDeepZoomGeneratorOSD
+
+
+def _open_associated(
+    images: Mapping[str, Image.Image],
+    name: str,
+    dz_opts: dict[str, Any],
+    mpp: float,
+    transform: Transform,
+) -> Any:
+    """Open an associated image as a Deep Zoom slide."""
+    image = images[name]
+    if image is None:
+        # listed but unreadable
+        raise ValueError(f"Cannot read associated image {name}")
+    image_slide_cls, generator_cls = _get_osd()
+    image_slide = generator_cls(image_slide_cls(image), **dz_opts)
+    image_slide.filename = name
+    image_slide.mpp = mpp
+    image_slide.transform = transform
+    return image_slide
+
+
+TileKey: TypeAlias = tuple[str, int, int, int, int]
+SlideHook: TypeAlias = Callable[[str, AnnotatedDeepZoomGenerator], Any]
 
 
 class _SlideCache:
+    # distinct uniform tiles kept; edge tiles come in many sizes
+    UNIFORM_TILES_SIZE = 256
+
     def __init__(
         self,
         cache_size: int,
         dz_opts: dict[str, Any],
         color_mode: ColorMode,
+        tile_cache_size: int = 4096,
     ):
         self.cache_size = cache_size
         self.dz_opts = dz_opts
         self.color_mode = color_mode
+        self.tile_cache_size = tile_cache_size
+        # the lock only guards dict operations, slides are opened outside
+        # it
         self._lock = Lock()
-        self._cache: OrderedDict[Path, AnnotatedDeepZoomGenerator] = (
-            OrderedDict()
-        )
-        # TODO: Share a single tile cache among all slide handles, if supported
+        # keyed by canonical path string, see create_app's slide_key
+        self._cache: OrderedDict[str, Any] = OrderedDict()
+        # encoded tiles, keyed by (slide key, level, col, row, quality)
+        self._tile_lock = Lock()
+        self._tile_cache: OrderedDict[TileKey, bytes] = OrderedDict()
+        # one encoded blob per uniform (e.g. blank background) tile look
+        self._uniform_tiles: OrderedDict[tuple, bytes] = OrderedDict()
+        # decoded tiles live in large_image's process-wide cache, which all
+        # slide handles share, see create_app
+        # called with the key and handle of each newly opened slide
+        self.on_load: SlideHook | None = None
 
-    def get(self, path: Path) -> AnnotatedDeepZoomGenerator:
+    def put(self, key: str, slide: Any) -> Any:
+        """Insert a slide handle unless one is already cached under `key`,
+        and return the cached handle.  A functools.partial is opened by the
+        first get."""
         with self._lock:
-            if path in self._cache:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+            if len(self._cache) >= self.cache_size:
+                self._cache.popitem(last=False)
+            self._cache[key] = slide
+            return slide
+
+    def get(self, key: str) -> AnnotatedDeepZoomGenerator:
+        with self._lock:
+            slide = self._cache.get(key)
+            if slide is not None:
                 # Move to end of LRU
-                slide = self._cache.pop(path)
-                self._cache[path] = slide
-                return slide
+                self._cache.move_to_end(key)
+        if isinstance(slide, functools.partial):
+            # open it without holding up lookups of other slides; it stays
+            # cached meanwhile, a concurrent get may open it too
+            opened = slide()
+            with self._lock:
+                cached = self._cache.get(key)
+                if cached is not None and not isinstance(
+                    cached, functools.partial
+                ):
+                    # another get opened it first
+                    return cached
+                if cached is None and len(self._cache) >= self.cache_size:
+                    self._cache.popitem(last=False)
+                self._cache[key] = opened
+                return opened
+        if slide is not None:
+            return slide
 
-        slide = AnnotatedDeepZoomGenerator(path, **self.dz_opts)
-        # pylint: disable=protected-access
-        if (
-            slide._metadata.get("mm_x") is not None
-            and slide._metadata.get("mm_y") is not None
-        ):
-            slide.mpp = (
-                (slide._metadata["mm_x"] + slide._metadata["mm_y"])
-                * (10**3)
-                / 2
-            )
-        elif slide._metadata.get("mm_x") is not None:
-            slide.mpp = slide._metadata["mm_x"] * (10**3)
-        elif slide._metadata.get("mm_y") is not None:
-            slide.mpp = slide._metadata["mm_y"] * (10**3)
-        else:
-            slide.mpp = 0
+        slide = AnnotatedDeepZoomGenerator(key, **self.dz_opts)
+        slide.filename = os.path.basename(key)
+        # microns per pixel, 0 when unknown
+        slide.mpp = slide._mpp or 0  # pylint: disable=protected-access
         slide.transform = self._get_transform(slide.get_icc_profile)
+        cached = self.put(key, slide)
+        if cached is slide and self.on_load is not None:
+            self.on_load(key, slide)
+        return cached
 
-        with self._lock:
-            if path not in self._cache:
-                if len(self._cache) == self.cache_size:
-                    self._cache.popitem(last=False)
-                self._cache[path] = slide
-        return slide
+    def get_tile_bytes(self, key: TileKey) -> bytes | None:
+        with self._tile_lock:
+            data = self._tile_cache.get(key)
+            if data is not None:
+                # Move to end of LRU
+                self._tile_cache.move_to_end(key)
+            return data
+
+    def tile_cache_contended(self) -> bool:
+        return self._tile_lock.locked()
+
+    def put_tile_bytes(
+        self,
+        key: TileKey,
+        tile: Image.Image,
+        transform: Transform,
+        encode: Callable[[], bytes],
+    ) -> bytes:
+        """Cache and return the encoded tile, transforming and encoding the
+        untransformed `tile` with `encode`.
+
+        Uniform tiles share one encoded blob per color, size, ICC profile
+        and transform, so the background of every slide is encoded once."""
+        extrema = tile.getextrema()
+        if all(lo == hi for lo, hi in extrema):
+            uniform_key = (
+                extrema,
+                tile.size,
+                key[-1],
+                tile.info.get("icc_profile"),
+                transform,
+            )
+            with self._tile_lock:
+                data = self._uniform_tiles.get(uniform_key)
+                if data is not None:
+                    self._uniform_tiles.move_to_end(uniform_key)
+            if data is None:
+                data = encode()
+                with self._tile_lock:
+                    data = self._uniform_tiles.setdefault(uniform_key, data)
+                    if len(self._uniform_tiles) > self.UNIFORM_TILES_SIZE:
+                        self._uniform_tiles.popitem(last=False)
+        else:
+            data = encode()
+        with self._tile_lock:
+            self._tile_cache[key] = data
+            self._tile_cache.move_to_end(key)
+            if len(self._tile_cache) > self.tile_cache_size:
+                self._tile_cache.popitem(last=False)
+        return data
 
     def _get_transform(
         self, color_profile: ImageCms.ImageCmsProfile
     ) -> Transform:
         if color_profile is None:
-            return lambda img: None
+            return _no_transform
         mode = self.color_mode
         if mode == "ignore":
             # drop ICC profile from tiles
-            return lambda img: img.info.pop("icc_profile")
+            return _drop_icc
         if mode == "embed":
             # embed ICC profile in tiles
-            return lambda img: None
+            return _no_transform
+        profile_bytes = color_profile.tobytes()
         if mode == "default":
             intent = ImageCms.Intent(ImageCms.getDefaultIntent(color_profile))
         elif mode == "absolute-colorimetric":
@@ -136,40 +495,160 @@ class _SlideCache:
             intent = ImageCms.Intent.SATURATION
         else:
             raise ValueError(f"Unknown color mode {mode}")
-        transform = ImageCms.buildTransform(
-            color_profile,
-            SRGB_PROFILE,
-            "RGB",
-            "RGB",
-            intent,
-            ImageCms.Flags(0),
-        )
+        if (
+            profile_bytes == SRGB_PROFILE_BYTES
+            or ImageCms.getProfileDescription(color_profile).strip()
+            in SRGB_PROFILE_DESCRIPTIONS
+        ):
+            # already sRGB, only the embedded profile needs replacing
+            return _embed_srgb
+        return _ColorTransform(profile_bytes, intent)
+
+
+class _TileCoalescer:
+    """Gather requests for tiles of the same slide level that arrive within
+    `window` seconds, and read them with one getRegion call.
+
+    Viewers request neighbouring tiles back to back, and render_tile
+    prefetches the eight neighbours of each tile at once.  A request that
+    finds no other read of its level in flight is read right away, so a
+    lone cache miss never waits for the window."""
+
+    # read no more than this many tiles per tile requested
+    MAX_SPREAD = 2
+
+    def __init__(self, window: float):
+        self.window = window
+        self._lock = Lock()
+        self._batches: dict[
+            tuple[str, int], dict[tuple[int, int], Future[Image.Image]]
+        ] = {}
+        # reads in progress per (key, level)
+        self._reading: dict[tuple[str, int], int] = {}
+
+    def get_tile(
+        self,
+        key: str,
+        slide: DeepZoomGenerator,
+        level: int,
+        address: tuple[int, int],
+    ) -> Image.Image:
+        """Return the tile of `slide`, cached under `key` in the slide
+        cache, at `address` of `level`."""
+        batch_key = (key, level)
+        with self._lock:
+            batch = self._batches.get(batch_key)
+            joined = batch is not None
+            if joined:
+                if address in batch:
+                    # tiles are transformed in place, so this one can't be
+                    # shared
+                    future = None
+                else:
+                    future = batch[address] = Future()
+            else:
+                if self._reading.get(batch_key):
+                    # another read of this level is in flight, gather the
+                    # requests that arrive meanwhile
+                    batch = self._batches[batch_key] = {address: Future()}
+                self._reading[batch_key] = self._reading.get(batch_key, 0) + 1
+        if joined:
+            if future is None:
+                return slide.get_tile(level, address)
+            return future.result()
+        try:
+            if batch is None:
+                # nothing to wait for
+                return slide.get_tile(level, address)
+            time.sleep(self.window)
+            with self._lock:
+                # later requests start the next batch
+                del self._batches[batch_key]
+            self._read(slide, level, batch)
+            return batch[address].result()
+        finally:
+            with self._lock:
+                self._reading[batch_key] -= 1
+                if not self._reading[batch_key]:
+                    del self._reading[batch_key]
+
+    def _read(
+        self,
+        slide: DeepZoomGenerator,
+        level: int,
+        batch: dict[tuple[int, int], Future[Image.Image]],
+    ) -> None:
+        cols = [col for col, _ in batch]
+        rows = [row for _, row in batch]
+        spread = (max(cols) - min(cols) + 1) * (max(rows) - min(rows) + 1)
+        if 1 < len(batch) and spread <= self.MAX_SPREAD * len(batch):
+            try:
+                tiles = slide.get_tiles(level, batch)
+            except Exception:  # pylint: disable=broad-except
+                # e.g. an address outside the level, read them one by one
+                # so only those requests fail
+                pass
+            else:
+                for address, future in batch.items():
+                    future.set_result(tiles[address])
+                return
+        for address, future in batch.items():
+            try:
+                future.set_result(slide.get_tile(level, address))
+            except Exception as e:  # pylint: disable=broad-except
+                future.set_exception(e)
+
+
+# readable without asking large_image, which opens the file to sniff it
+_SLIDE_EXTENSIONS = frozenset(
+    {".bif", ".mrxs", ".ndpi", ".scn", ".svs", ".svslide", ".tif", ".tiff"}
+)
 
-        def xfrm(img: Image.Image) -> None:
-            ImageCms.applyTransform(img, transform, True)
-            # Some browsers assume we intend the display's color space if we
-            # don't embed the profile.  Pillow's serialization is larger, so
-            # use ours.
-            img.info["icc_profile"] = SRGB_PROFILE_BYTES
 
-        return xfrm
+def _can_read(path: str) -> bool:
+    if os.path.splitext(path)[1].lower() in _SLIDE_EXTENSIONS:
+        return True
+    return DeepZoomGenerator.can_read(path)
 
 
 class _Directory:
     _DEFAULT_RELPATH = PurePath(".")
 
-    def __init__(self, slidedir: Path, relpath: PurePath = _DEFAULT_RELPATH):
+    def __init__(
+        self,
+        slidedir: Path,
+        relpath: PurePath = _DEFAULT_RELPATH,
+        mtimes: dict[str, int] | None = None,
+    ):
         self.name = relpath.name
         self.children: list[_Directory | _SlideFile] = []
-        for cur_path in sorted((slidedir / relpath).iterdir()):
-            cur_relpath = relpath / cur_path.name
-            if cur_path.is_dir():
-                cur_dir = _Directory(slidedir, cur_relpath)
+        # modification times of every directory in the tree, to tell when
+        # it's stale
+        self.mtimes = {} if mtimes is None else mtimes
+        dirpath = os.path.join(slidedir, relpath)
+        with os.scandir(dirpath) as it:
+            self.mtimes[dirpath] = os.stat(dirpath).st_mtime_ns
+            entries = sorted(it, key=lambda entry: entry.name)
+        for entry in entries:
+            cur_relpath = relpath / entry.name
+            # DirEntry caches the file type, no stat per entry
+            if entry.is_dir():
+                cur_dir = _Directory(slidedir, cur_relpath, self.mtimes)
                 if cur_dir.children:
                     self.children.append(cur_dir)
-            elif DeepZoomGenerator.can_read(cur_path):
+            elif _can_read(entry.path):
                 self.children.append(_SlideFile(cur_relpath))
 
+    def is_current(self) -> bool:
+        try:
+            return all(
+                os.stat(dirpath).st_mtime_ns == mtime
+                for dirpath, mtime in self.mtimes.items()
+            )
+        except OSError:
+            # removed
+            return False
+
 
 class _SlideFile:
     def __init__(self, relpath: PurePath):
@@ -179,7 +658,13 @@ class _SlideFile:
 
 class DeepZoomMultiServer(FastAPI):
     slidedir: Path
+    tile_store: Path | None
+    prefetch_pool: ThreadPoolExecutor | None
+    prewarm_pool: ThreadPoolExecutor | None
+    encoder_pool: ProcessPoolExecutor | None
+    coalescer: _TileCoalescer | None
     cache: _SlideCache
+    dir_tree: _Directory | None
     users: dict[str, Any]
 
 
@@ -207,16 +692,41 @@ def create_app(
         config=dict(
             SLIDE_DIR=".",
             SLIDE_CACHE_SIZE=30,
+            DEEPZOOM_TILE_CACHE_SIZE=4096,
             DEEPZOOM_TILE_SIZE=254,
             DEEPZOOM_OVERLAP=1,
             DEEPZOOM_LIMIT_BOUNDS=True,
             DEEPZOOM_TILE_QUALITY=75,
             DEEPZOOM_COLOR_MODE="default",
+            DEEPZOOM_CACHE_BACKEND="python",
+            DEEPZOOM_CACHE_MEMORY_PORTION=8,
+            DEEPZOOM_DISABLE_TILECACHE=False,
+            DEEPZOOM_TILE_STORE=None,
+            DEEPZOOM_PREFETCH_WORKERS=2,
+            DEEPZOOM_PREWARM_LEVELS=5,
+            DEEPZOOM_PREWARM_MAX_TILES=256,
+            DEEPZOOM_COALESCE_WINDOW_MS=5,
+            DEEPZOOM_ENCODER_PROCESSES=0,
         )
     )
     if config is not None:
         settings.config.update(config)
 
+    # One tile cache shared by every tile source, sized as a portion of the
+    # available memory (1/N).  Workloads reading each tile once gain nothing
+    # from it, they can shrink it to a token size instead.
+    large_image.config.setConfig(
+        "cache_backend", settings.config["DEEPZOOM_CACHE_BACKEND"]
+    )
+    large_image.config.setConfig(
+        "cache_python_memory_portion",
+        (
+            1024
+            if settings.config["DEEPZOOM_DISABLE_TILECACHE"]
+            else settings.config["DEEPZOOM_CACHE_MEMORY_PORTION"]
+        ),
+    )
+
     # Set up cache
     app.slidedir = Path(settings.config["SLIDE_DIR"]).resolve(strict=True)
     config_map = {
@@ -229,45 +739,292 @@ def create_app(
         settings.config["SLIDE_CACHE_SIZE"],
         opts,
         settings.config["DEEPZOOM_COLOR_MODE"],
+        settings.config["DEEPZOOM_TILE_CACHE_SIZE"],
     )
     app.users = {}
+    # slide listing, rebuilt when a directory in it changes
+    app.dir_tree = None
+    # rendered tiles persisted as {slide}/{level}/{col}_{row}.jpg, clear it
+    # when changing tile size, quality or color mode
+    app.tile_store = (
+        Path(settings.config["DEEPZOOM_TILE_STORE"]).resolve()
+        if settings.config["DEEPZOOM_TILE_STORE"]
+        else None
+    )
+    # renders the neighbours of freshly rendered tiles in the background
+    app.prefetch_pool = (
+        ThreadPoolExecutor(
+            max_workers=settings.config["DEEPZOOM_PREFETCH_WORKERS"]
+        )
+        if settings.config["DEEPZOOM_PREFETCH_WORKERS"]
+        else None
+    )
+    # renders the top of newly opened slides' pyramids in the background,
+    # two at a time so live requests keep the upper hand
+    app.prewarm_pool = (
+        ThreadPoolExecutor(max_workers=2)
+        if settings.config["DEEPZOOM_PREWARM_LEVELS"]
+        else None
+    )
+    # reads tiles requested together with one getRegion; only requests
+    # arriving while another read of their level is in flight wait for the
+    # window
+    app.coalescer = (
+        _TileCoalescer(settings.config["DEEPZOOM_COALESCE_WINDOW_MS"] / 1000)
+        if settings.config["DEEPZOOM_COALESCE_WINDOW_MS"]
+        else None
+    )
+    # optionally, color conversion and JPEG encoding run in worker
+    # processes; started by a fork server (spawn where there is none),
+    # never forked from this threaded process
+    app.encoder_pool = (
+        ProcessPoolExecutor(
+            max_workers=settings.config["DEEPZOOM_ENCODER_PROCESSES"],
+            mp_context=multiprocessing.get_context(
+                "forkserver"
+                if "forkserver" in multiprocessing.get_all_start_methods()
+                else "spawn"
+            ),
+        )
+        if settings.config["DEEPZOOM_ENCODER_PROCESSES"]
+        else None
+    )
 
     # Helper functions
-    def get_slide(user_path: PurePath) -> AnnotatedDeepZoomGenerator:
-        try:
-            path = (app.slidedir / user_path).resolve(strict=True)
-        except OSError as e:
-            # Does not exist
-            raise HTTPException(status_code=404) from e
-        if path.parts[: len(app.slidedir.parts)] != app.slidedir.parts:
+    # with the trailing separator, so /slides2 doesn't pass for /slides
+    slidedir_prefix = os.path.join(app.slidedir, "")
+
+    def slide_key(user_path: str) -> str:
+        """Return the slide cache key for a URL path: however the URL
+        spells it, a slide is loaded and cached once."""
+        # plain strings, this runs for every request; and not strict,
+        # associated images are cached under paths that don't exist on disk
+        key = os.path.realpath(os.path.join(slidedir_prefix, user_path))
+        if not key.startswith(slidedir_prefix):
             # Directory traversal
             raise HTTPException(status_code=404)
+        return key
+
+    def get_slide(user_path: str) -> AnnotatedDeepZoomGenerator:
+        return load_slide(slide_key(user_path))
+
+    def load_slide(key: str) -> AnnotatedDeepZoomGenerator:
         try:
-            slide = app.cache.get(path)
-            slide.filename = path.name
-            return slide
+            return app.cache.get(key)
         except Exception as e:
+            # Does not exist, or not a slide
             print(e)
             raise HTTPException(status_code=404) from e
 
     # Set up routes
     @app.get("/", response_class=HTMLResponse)
     def index(request: Request):
+        root_dir = app.dir_tree
+        if root_dir is None or not root_dir.is_current():
+            root_dir = app.dir_tree = _Directory(app.slidedir)
         return templates.TemplateResponse(
             "files.html",
-            {"request": request, "root_dir": _Directory(app.slidedir)},
+            {"request": request, "root_dir": root_dir},
         )
 
     # note the order of these three routes matters
     @app.get("/{path:path}.dzi")
     def dzi(path: str) -> Response:
-        try:
-            slide = app.cache.get(path)
-        except Exception:  # pylint: disable=broad-except
-            slide = get_slide(PurePath(path))
-        return Response(
-            content=slide.get_dzi("jpeg"), media_type="application/xml"
+        slide = get_slide(path)
+        return Response(content=slide.dzi_bytes, media_type="application/xml")
+
+    def tile_store_path(
+        path: str, level: int, col: int, row: int
+    ) -> Path | None:
+        if app.tile_store is None:
+            return None
+        store_path = Path(
+            os.path.normpath(
+                app.tile_store / path / str(level) / f"{col}_{row}.jpg"
+            )
         )
+        if not store_path.is_relative_to(app.tile_store):
+            # Directory traversal
+            return None
+        return store_path
+
+    def store_tile(
+        path: str, level: int, col: int, row: int, data: bytes
+    ) -> None:
+        store_path = tile_store_path(path, level, col, row)
+        if store_path is None or store_path.is_file():
+            return
+        store_path.parent.mkdir(parents=True, exist_ok=True)
+        # write aside and rename, readers never see a partial file
+        with tempfile.NamedTemporaryFile(
+            dir=store_path.parent, suffix=".tmp", delete=False
+        ) as tmp:
+            tmp.write(data)
+        os.replace(tmp.name, store_path)
+
+    def render_tile(
+        path: str,
+        level: int,
+        col: int,
+        row: int,
+        prefetch: bool = True,
+        store: bool = True,
+        tile: Image.Image | None = None,
+    ) -> bytes:
+        """Return the encoded tile, rendering it on a cache miss.
+
+        The tile is persisted to the tile store, if one is configured,
+        `store` is set and it isn't there yet, cache hits included.  With
+        `prefetch` its eight neighbours are rendered into the tile cache in
+        the background.  `tile` is the tile if it has been read already."""
+        quality = settings.config["DEEPZOOM_TILE_QUALITY"]
+        # however the URL spells the slide, its tiles are cached and read
+        # once; the tile store follows the URL, it only ever writes there
+        skey = slide_key(path)
+        key = (skey, level, col, row, quality)
+        data = app.cache.get_tile_bytes(key)
+        if data is not None:
+            if store:
+                # e.g. prefetched, or cached before the tile store was
+                # cleared
+                store_tile(path, level, col, row, data)
+            return data
+        slide = load_slide(skey)
+        if tile is None:
+            try:
+                if app.coalescer is not None and isinstance(
+                    slide, DeepZoomGenerator
+                ):
+                    tile = app.coalescer.get_tile(
+                        skey, slide, level, (col, row)
+                    )
+                else:
+                    # associated images
+                    tile = slide.get_tile(level, (col, row))
+            except ValueError as e:
+                # Invalid level or coordinates
+                raise HTTPException(status_code=404) from e
+        transform = slide.transform
+
+        def encode() -> bytes:
+            if app.encoder_pool is None:
+                transform(tile)
+                return _encode_jpeg(
+                    tile, quality, tile.info.get("icc_profile")
+                )
+            # blocks this thread only, the GIL is free while we wait
+            call_args = (
+                np.asarray(tile),
+                tile.info.get("icc_profile"),
+                transform,
+                quality,
+            )
+            try:
+                return app.encoder_pool.submit(
+                    _transform_and_encode, *call_args
+                ).result()
+            except _UnknownProfileError:
+                # first tile with this profile in that process, send the
+                # profile along once
+                return app.encoder_pool.submit(
+                    _transform_and_encode, *call_args, transform.profile_bytes
+                ).result()
+
+        data = app.cache.put_tile_bytes(key, tile, transform, encode)
+        if (
+            prefetch
+            and app.prefetch_pool is not None
+            # don't pile onto a busy cache
+            and not app.cache.tile_cache_contended()
+        ):
+            for dc, dr in _NEIGHBOURS:
+                if col + dc >= 0 and row + dr >= 0:
+                    submit_prefetch(path, level, col + dc, row + dr)
+        if store:
+            store_tile(path, level, col, row, data)
+        return data
+
+    def render_level(
+        path: str, slide: DeepZoomGenerator, level: int, store: bool
+    ) -> int:
+        """Render every tile of a level, reading each row of tiles with one
+        getRegion, and return the number of tiles."""
+        cols, rows = slide.level_tiles[level]
+        for row in range(rows):
+            if not isinstance(slide, DeepZoomGenerator):
+                # associated images
+                for col in range(cols):
+                    render_tile(path, level, col, row, store=store)
+                continue
+            # the whole row is wanted, no need to wait for the coalescer
+            tiles = slide.get_tiles(level, [(col, row) for col in range(cols)])
+            for (col, _), tile in tiles.items():
+                render_tile(
+                    path,
+                    level,
+                    col,
+                    row,
+                    prefetch=False,
+                    store=store,
+                    tile=tile,
+                )
+        return cols * rows
+
+    def render_top(
+        path: str, slide: AnnotatedDeepZoomGenerator, levels: int
+    ) -> int:
+        """Render the top levels of a slide, as many as fit in
+        DEEPZOOM_PREWARM_MAX_TILES tiles, see _top_levels, and return the
+        number of tiles."""
+        budget = settings.config["DEEPZOOM_PREWARM_MAX_TILES"]
+        count = 0
+        for level in _top_levels(slide, levels):
+            cols, rows = slide.level_tiles[level]
+            if count + cols * rows > budget:
+                break
+            count += render_level(path, slide, level, store=True)
+        return count
+
+    def prewarm(key: str, slide: AnnotatedDeepZoomGenerator) -> None:
+        # the URL path, as linked from the index, which tiles are keyed by
+        path = PurePath(os.path.relpath(key, app.slidedir)).as_posix()
+        render_top(path, slide, settings.config["DEEPZOOM_PREWARM_LEVELS"])
+
+    if app.prewarm_pool is not None:
+        prewarm_pool = app.prewarm_pool
+        app.cache.on_load = lambda key, slide: prewarm_pool.submit(
+            prewarm, key, slide
+        )
+
+    # tiles queued or being rendered by prefetch_pool
+    prefetching: set[tuple[str, int, int, int]] = set()
+    prefetch_lock = Lock()
+
+    def submit_prefetch(path: str, level: int, col: int, row: int) -> None:
+        """Queue a tile for prefetch_tile, unless it is queued already, or
+        _PREFETCH_QUEUE_SIZE tiles are: a prefetch that has to wait for
+        that many others is too late to help."""
+        address = (path, level, col, row)
+        with prefetch_lock:
+            if (
+                address in prefetching
+                or len(prefetching) >= _PREFETCH_QUEUE_SIZE
+            ):
+                return
+            prefetching.add(address)
+        app.prefetch_pool.submit(prefetch_tile, *address)
+
+    def prefetch_tile(path: str, level: int, col: int, row: int) -> None:
+        try:
+            # into the tile cache only, the first request for the tile
+            # writes it to the tile store
+            render_tile(path, level, col, row, prefetch=False, store=False)
+        except HTTPException:
+            # past the edge of the level
+            pass
+        finally:
+            with prefetch_lock:
+                prefetching.discard((path, level, col, row))
 
     @app.get(
         "/{path:path}_files/{level:int}/{col:int}_{row:int}.{format_:str}"
@@ -275,48 +1032,48 @@ def create_app(
     def tile(
         path: str, level: int, col: int, row: int, format_: str
     ) -> Response:
-        try:
-            slide = app.cache.get(path)
-        except Exception:  # pylint: disable=broad-except
-            slide = get_slide(PurePath(path))
         format_ = format_.lower()
         if format_ != "jpeg":
             # Not supported by DeepZoomGenerator
             raise HTTPException(status_code=404)
-        try:
-            tile = slide.get_tile(level, (col, row))
-        except ValueError as e:
-            # Invalid level or coordinates
-            raise HTTPException(status_code=404) from e
-        slide.transform(tile)
-        buf = BytesIO()
-        tile.save(
-            buf,
-            format_,
-            quality=settings.config["DEEPZOOM_TILE_QUALITY"],
-            icc_profile=tile.info.get("icc_profile"),
+        store_path = tile_store_path(path, level, col, row)
+        if store_path is not None and store_path.is_file():
+            return FileResponse(store_path, media_type=f"image/{format_}")
+        return Response(
+            content=render_tile(path, level, col, row),
+            media_type=f"image/{format_}",
         )
-        return Response(content=buf.getvalue(), media_type=f"image/{format_}")
+
+    @app.post("/{path:path}_files/warm")
+    def warm(path: str, levels: int = 5) -> Response:
+        """Render the top of a slide's pyramid ahead of time, into the tile
+        cache and the tile store, see render_top."""
+        slide = get_slide(path)
+        count = render_top(path, slide, max(0, min(levels, _MAX_WARM_LEVELS)))
+        return Response(content=f"{count} tiles", media_type="text/plain")
 
     # this one should be the last one
     @app.get("/{path:path}")
     def slide(path: str, request: Request):
-        slide = get_slide(PurePath(path))
+        slide = get_slide(path)
         slide_url = app.url_path_for("dzi", path=path)
-        for name, image in slide.associated_images.items():
+        associated_urls = {}
+        for name in slide.associated_images:
             image_path = f"{path}_{name}"
-            # pylint: disable=protected-access
-            app.cache._cache[image_path] = AnnotatedDeepZoomGeneratorOSD(
-                ImageSlide(image), **opts
+            # read and opened when its first tile is requested
+            app.cache.put(
+                slide_key(image_path),
+                functools.partial(
+                    _open_associated,
+                    slide.associated_images,
+                    name,
+                    opts,
+                    slide.mpp,
+                    slide.transform,
+                ),
             )
-            app.cache._cache[image_path].filename = name
-            app.cache._cache[image_path].mpp = slide.mpp
-            app.cache._cache[image_path].transform = slide.transform
-        associated_urls = {
             # treat associated images as slide files
-            name: app.url_path_for("dzi", path=f"{path}_{name}")
-            for name in slide.associated_images
-        }
+            associated_urls[name] = app.url_path_for("dzi", path=image_path)
         return templates.TemplateResponse(
             "slide-multipane.html",
             {
@@ -395,6 +1152,14 @@ if __name__ == "__main__":
         default=5000,
         help="port to listen on [5000]",
     )
+    parser.add_argument(
+        "-P",
+        "--encoder-processes",
+        metavar="COUNT",
+        dest="DEEPZOOM_ENCODER_PROCESSES",
+        type=int,
+        help="processes encoding tiles, 0 to encode in-thread [0]",
+    )
     parser.add_argument(
         "-Q",
         "--quality",
@@ -411,6 +1176,14 @@ if __name__ == "__main__":
         type=int,
         help="tile size [254]",
     )
+    parser.add_argument(
+        "-t",
+        "--tile-store",
+        metavar="DIRECTORY",
+        dest="DEEPZOOM_TILE_STORE",
+        type=str,
+        help="persist rendered tiles in this directory [off]",
+    )
     parser.add_argument(
         "SLIDE_DIR",
         metavar="SLIDE-DIRECTORY",
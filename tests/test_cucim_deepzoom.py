@@ -0,0 +1,81 @@
+import os
+import random
+import sys
+import unittest
+from types import SimpleNamespace
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# pylint: disable=wrong-import-position
+
+from dz_py.deepzoom import DeepZoomGenerator as LargeImageGenerator
+
+try:
+    from cucim_py.deepzoom import DeepZoomGenerator, _region_bounds
+except ImportError as e:  # needs cupy and cucim, and a GPU
+    raise unittest.SkipTest(f"cuCIM generator unavailable: {e}") from e
+
+
+class RegionBoundsVecTest(unittest.TestCase):
+    def test_matches_scalar(self):  # pylint: disable=too-many-locals
+        rng = random.Random(0)
+        for _ in range(200):
+            tile_size = rng.choice((254, 256, 510, 512))
+            overlap = rng.choice((0, 1, 2, 8))
+            lfactor = 1 << rng.randrange(6)
+            size_x = rng.randrange(1, 100_000)
+            size_y = rng.randrange(1, 100_000)
+            # the generator's attributes the method reads
+            dz = SimpleNamespace(
+                _tile_size=tile_size,
+                _tile_overlap=overlap,
+                _size_x=size_x,
+                _size_y=size_y,
+            )
+            cols = -(-size_x // (tile_size * lfactor))
+            rows = -(-size_y // (tile_size * lfactor))
+            xs = np.array([rng.randrange(cols) for _ in range(16)])
+            ys = np.array([rng.randrange(rows) for _ in range(16)])
+            # pylint: disable=protected-access
+            bounds = DeepZoomGenerator._region_bounds_vec(dz, xs, ys, lfactor)
+            for i, (x, y) in enumerate(zip(xs.tolist(), ys.tolist())):
+                self.assertEqual(
+                    tuple(int(b[i]) for b in bounds),
+                    _region_bounds(
+                        x, y, tile_size, overlap, lfactor, size_x, size_y
+                    ),
+                )
+
+    def test_outside_layer(self):
+        dz = SimpleNamespace(
+            _tile_size=254, _tile_overlap=1, _size_x=1000, _size_y=1000
+        )
+        with self.assertRaises(ValueError):
+            # pylint: disable=protected-access
+            DeepZoomGenerator._region_bounds_vec(
+                dz, np.array([0, 4]), np.array([0, 0]), 1
+            )
+
+
+class Dimensions:
+    """The attributes both generators build the .dzi from."""
+
+    _tile_size = 254
+    _tile_overlap = 1
+    _size_x = 98304
+    _size_y = 53760
+
+
+class DziTest(unittest.TestCase):
+    def test_matches_large_image_generator(self):
+        dims = Dimensions()
+        # pylint: disable=protected-access
+        self.assertEqual(
+            DeepZoomGenerator._dzi.fget(dims),
+            LargeImageGenerator._dzi.fget(dims),
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
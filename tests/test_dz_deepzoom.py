@@ -0,0 +1,134 @@
+import os
+import sys
+import tempfile
+import unittest
+from io import BytesIO
+
+import large_image
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# pylint: disable=wrong-import-position
+
+from dz_py.deepzoom import DeepZoomGenerator
+
+
+class GetTilesTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # pylint: disable-next=consider-using-with
+        cls.tmp = tempfile.TemporaryDirectory()
+        path = os.path.join(cls.tmp.name, "slide.png")
+        # odd sizes, so regions get clipped at the edges
+        pixels = np.random.default_rng(0).integers(
+            0, 256, (1237, 1999, 3), np.uint8
+        )
+        Image.fromarray(pixels).save(path)
+        if not large_image.tilesource.canRead(path):
+            raise unittest.SkipTest("no large_image tile source reads PNG")
+        cls.dz = DeepZoomGenerator(path)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp.cleanup()
+
+    def test_sizes_match_get_tile(self):
+        for level in range(1, self.dz.dzi_level_count + 1):
+            cols, rows = self.dz.level_tiles[level]
+            addresses = [
+                (col, row) for row in range(rows) for col in range(cols)
+            ]
+            tiles = self.dz.get_tiles(level, addresses)
+            self.assertEqual(sorted(tiles), sorted(addresses))
+            for address in addresses:
+                self.assertEqual(
+                    tiles[address].size,
+                    self.dz.get_tile(level, address).size,
+                    (level, address),
+                )
+
+    def test_outside_layer(self):
+        level = self.dz.dzi_level_count
+        cols, _ = self.dz.level_tiles[level]
+        with self.assertRaises(ValueError):
+            self.dz.get_tiles(level, [(0, 0), (cols, 0)])
+
+
+class FakeTileSource:
+    """A 1024x768 source stored as 256x256 tiles, whose getTile hands out
+    the same object every time, like large_image's tile cache."""
+
+    def __init__(self, tile):
+        self.tile = tile
+        self.calls = []
+
+    def getMetadata(self):  # pylint: disable=invalid-name
+        return {
+            "sizeX": 1024,
+            "sizeY": 768,
+            "levels": 3,
+            "tileWidth": 256,
+            "tileHeight": 256,
+        }
+
+    def getTile(self, x, y, z, pilImageAllowed=False):
+        # pylint: disable=invalid-name,unused-argument
+        self.calls.append(("getTile", x, y, z))
+        return self.tile
+
+    def getRegion(self, **kwargs):  # pylint: disable=invalid-name
+        self.calls.append(("getRegion",))
+        output = kwargs["output"]
+        return (
+            Image.new("RGB", (output["maxWidth"], output["maxHeight"])),
+            None,
+        )
+
+
+class FakeSourceGenerator(DeepZoomGenerator):
+    def __init__(self, source, **kwargs):
+        super().__init__("fake", **kwargs)
+        self.source = source
+
+    @property
+    def _tile_source(self):  # pylint: disable=invalid-overridden-method
+        return self.source
+
+
+class GetTileFastPathTest(unittest.TestCase):
+    def get_tile(self, tile, address=(1, 2)):
+        source = FakeTileSource(tile)
+        dz = FakeSourceGenerator(source, tile_size=256, overlap=0)
+        img = dz.get_tile(dz.dzi_level_count, address)
+        return source, img
+
+    def test_reads_stored_tile(self):
+        cached = Image.new("RGB", (256, 256), (10, 20, 30))
+        source, img = self.get_tile(cached)
+        self.assertEqual(source.calls, [("getTile", 1, 2, 2)])
+        self.assertEqual(img.getpixel((0, 0)), (10, 20, 30))
+        # the cached tile is left alone by callers modifying theirs
+        img.paste((0, 0, 0), (0, 0, 256, 256))
+        self.assertEqual(cached.getpixel((0, 0)), (10, 20, 30))
+
+    def test_array_and_encoded_tiles(self):
+        array = np.full((256, 256, 3), 7, np.uint8)
+        _, img = self.get_tile(array)
+        self.assertEqual((img.mode, img.size), ("RGB", (256, 256)))
+        img.paste((0, 0, 0), (0, 0, 256, 256))
+        self.assertEqual(array[0, 0, 0], 7)
+        buf = BytesIO()
+        Image.new("RGB", (256, 256), (0, 255, 0)).save(buf, "png")
+        _, img = self.get_tile(buf.getvalue())
+        self.assertEqual(img.getpixel((5, 5)), (0, 255, 0))
+
+    def test_unaligned_tiles_use_get_region(self):
+        source = FakeTileSource(None)
+        dz = FakeSourceGenerator(source, tile_size=254, overlap=1)
+        dz.get_tile(dz.dzi_level_count, (1, 1))
+        self.assertEqual(source.calls, [("getRegion",)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,285 @@
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from io import BytesIO
+from pathlib import Path
+from typing import Any
+
+import large_image
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# pylint: disable=wrong-import-position
+
+try:
+    from fastapi.testclient import TestClient
+
+    from server import main
+except ImportError as e:  # needs the demo server's requirements
+    raise unittest.SkipTest(f"demo server unavailable: {e}") from e
+
+
+class ServerTestCase(unittest.TestCase):
+    """Serve a 2000x1500 slide, blank on the left, with a tile store."""
+
+    config: dict[str, Any] = {}
+
+    def setUp(self):
+        # pylint: disable-next=consider-using-with
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.root = Path(tmp.name)
+        slides = self.root / "slides"
+        slides.mkdir()
+        pixels = np.random.default_rng(0).integers(
+            0, 256, (1500, 2000, 3), np.uint8
+        )
+        pixels[:, :600] = 255
+        Image.fromarray(pixels).save(slides / "slide.png")
+        # the slide cache key, see create_app's slide_key
+        self.slide_key = os.path.realpath(slides / "slide.png")
+        if not large_image.tilesource.canRead(str(slides / "slide.png")):
+            self.skipTest("no large_image tile source reads PNG")
+        self.store = self.root / "store"
+        self.app = main.create_app(
+            {
+                "SLIDE_DIR": str(slides),
+                "DEEPZOOM_TILE_STORE": str(self.store),
+                "DEEPZOOM_PREWARM_LEVELS": 0,
+                **self.config,
+            }
+        )
+        self.client = TestClient(self.app)
+
+    def get_tile(self, level: int, col: int, row: int, path="slide.png"):
+        return self.client.get(f"/{path}_files/{level}/{col}_{row}.jpeg")
+
+    def stored(self, level: int) -> list[str]:
+        level_dir = self.store / "slide.png" / str(level)
+        return sorted(os.listdir(level_dir)) if level_dir.is_dir() else []
+
+
+class PrefetchTest(ServerTestCase):
+    def test_prefetched_tile_is_stored_when_requested(self):
+        self.assertEqual(self.get_tile(11, 1, 1).status_code, 200)
+        # let the neighbours render
+        self.app.prefetch_pool.shutdown(wait=True)
+        self.assertIsNotNone(
+            self.app.cache.get_tile_bytes((self.slide_key, 11, 2, 1, 75))
+        )
+        self.assertEqual(self.stored(11), ["1_1.jpg"])
+        self.assertEqual(self.get_tile(11, 2, 1).status_code, 200)
+        self.assertEqual(self.stored(11), ["1_1.jpg", "2_1.jpg"])
+
+
+if __name__ == "__main__":
+    unittest.main()
+
+
+class SlidePathTest(ServerTestCase):
+    def test_traversal_rejected(self):
+        outside = self.root / "outside.png"
+        Image.new("RGB", (300, 300)).save(outside)
+        self.assertEqual(self.client.get("/slide.png.dzi").status_code, 200)
+        for path in ("..%2Foutside.png", "%2E%2E/outside.png"):
+            self.assertEqual(
+                self.client.get(f"/{path}.dzi").status_code, 404, path
+            )
+        # resolved, not just normalized
+        os.symlink(outside, self.root / "slides" / "link.png")
+        self.assertEqual(self.client.get("/link.png.dzi").status_code, 404)
+
+
+class TileStoreTest(ServerTestCase):
+    def test_store_path_stays_in_store(self):
+        # beside the store, where store/../secret would lead
+        secret = self.root / "secret" / "11" / "0_0.jpg"
+        secret.parent.mkdir(parents=True)
+        secret.write_bytes(b"secret")
+        response = self.get_tile(11, 0, 0, path="..%2Fsecret")
+        self.assertEqual(response.status_code, 404)
+
+    def test_served_from_store(self):
+        first = self.get_tile(11, 1, 1)
+        stored = self.store / "slide.png" / "11" / "1_1.jpg"
+        self.assertEqual(stored.read_bytes(), first.content)
+        stored.write_bytes(b"stored")
+        self.assertEqual(self.get_tile(11, 1, 1).content, b"stored")
+
+    def test_warm_stores_every_counted_tile(self):
+        # some of the tiles are in the tile cache already
+        self.get_tile(9, 0, 0)
+        self.get_tile(10, 1, 1)
+        response = self.client.post("/slide.png_files/warm?levels=2")
+        self.assertEqual(response.status_code, 200)
+        count = int(response.text.split()[0])
+        stored = sum(len(files) for _, _, files in os.walk(self.store))
+        self.assertEqual(count, stored)
+        # levels is clamped, the tile budget still applies
+        response = self.client.post("/slide.png_files/warm?levels=50")
+        self.assertLessEqual(int(response.text.split()[0]), 256)
+
+
+class SlideKeyTest(ServerTestCase):
+    # neither served from the tile store nor mixed with prefetched tiles
+    config = {"DEEPZOOM_TILE_STORE": None, "DEEPZOOM_PREFETCH_WORKERS": 0}
+
+    def test_spellings_share_cached_tiles(self):
+        first = self.get_tile(11, 1, 1)
+        second = self.get_tile(11, 1, 1, path="sub%2F..%2F.%2Fslide.png")
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(first.content, second.content)
+        # pylint: disable=protected-access
+        self.assertEqual(list(self.app.cache._cache), [self.slide_key])
+        self.assertEqual(
+            list(self.app.cache._tile_cache),
+            [(self.slide_key, 11, 1, 1, 75)],
+        )
+
+
+class TileBytesCacheTest(unittest.TestCase):
+    def setUp(self):
+        # pylint: disable=protected-access
+        self.cache = main._SlideCache(1, {}, "default", tile_cache_size=2)
+        self.encoded = []
+
+    def put(self, key, tile):
+        def encode():
+            self.encoded.append(key)
+            return f"{key}".encode()
+
+        # pylint: disable-next=protected-access
+        return self.cache.put_tile_bytes(key, tile, main._no_transform, encode)
+
+    def test_lru(self):
+        noise = Image.effect_noise((16, 16), 64).convert("RGB")
+        keys = [("slide", 10, col, 0, 75) for col in range(3)]
+        self.put(keys[0], noise)
+        self.put(keys[1], noise)
+        # refresh the first, the second is the oldest now
+        self.assertIsNotNone(self.cache.get_tile_bytes(keys[0]))
+        self.put(keys[2], noise)
+        self.assertIsNotNone(self.cache.get_tile_bytes(keys[0]))
+        self.assertIsNone(self.cache.get_tile_bytes(keys[1]))
+        self.assertIsNotNone(self.cache.get_tile_bytes(keys[2]))
+
+    def test_uniform_tiles_encoded_once(self):
+        white = Image.new("RGB", (254, 254), "white")
+        first = self.put(("a", 10, 0, 0, 75), white)
+        second = self.put(("b", 12, 3, 4, 75), white.copy())
+        self.assertIs(first, second)
+        self.assertEqual(self.encoded, [("a", 10, 0, 0, 75)])
+        # another color, size or quality is another tile
+        self.put(("a", 10, 1, 0, 75), Image.new("RGB", (254, 254), "black"))
+        self.put(("a", 10, 2, 0, 75), Image.new("RGB", (100, 254), "white"))
+        self.put(("a", 10, 3, 0, 90), white)
+        self.assertEqual(len(self.encoded), 4)
+
+
+class EncodeJpegTest(unittest.TestCase):
+    def setUp(self):
+        self.tile = np.random.default_rng(0).integers(
+            0, 256, (254, 254, 3), np.uint8
+        )
+
+    def read_back(self, data: bytes) -> Image.Image:
+        img = Image.open(BytesIO(data))
+        img.load()
+        self.assertEqual(img.format, "JPEG")
+        self.assertEqual(img.size, (254, 254))
+        return img
+
+    def test_no_profile(self):
+        # pylint: disable=protected-access
+        img = self.read_back(main._encode_jpeg(self.tile, 75))
+        self.assertIsNone(img.info.get("icc_profile"))
+
+    def test_srgb_profile(self):
+        # the precomputed segments
+        # pylint: disable=protected-access
+        data = main._encode_jpeg(
+            Image.fromarray(self.tile), 75, main.SRGB_PROFILE_BYTES
+        )
+        img = self.read_back(data)
+        self.assertEqual(img.info["icc_profile"], main.SRGB_PROFILE_BYTES)
+
+    def test_multi_segment_profile(self):
+        # more than one APP2 segment holds
+        profile = bytes(range(256)) * 600
+        # pylint: disable=protected-access
+        img = self.read_back(main._encode_jpeg(self.tile, 75, profile))
+        self.assertEqual(img.info["icc_profile"], profile)
+
+
+class FakeSlide:
+    """Returns tiles of the requested address's size, after `gate` is set,
+    and records how they were read."""
+
+    def __init__(self):
+        self.gate = threading.Event()
+        self.gate.set()
+        self.reads = []
+
+    def get_tile(self, level, address):
+        self.gate.wait()
+        self.reads.append(("get_tile", level, address))
+        return Image.new("RGB", address)
+
+    def get_tiles(self, level, addresses):
+        addresses = sorted(addresses)
+        self.reads.append(("get_tiles", level, addresses))
+        return {address: Image.new("RGB", address) for address in addresses}
+
+
+class TileCoalescerTest(unittest.TestCase):
+    def test_lone_request_does_not_wait(self):
+        # pylint: disable=protected-access
+        coalescer = main._TileCoalescer(window=10)
+        slide = FakeSlide()
+        start = time.monotonic()
+        tile = coalescer.get_tile("slide", slide, 5, (1, 2))
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual(tile.size, (1, 2))
+        self.assertEqual(slide.reads, [("get_tile", 5, (1, 2))])
+
+    def test_requests_behind_a_read_are_batched(self):
+        # pylint: disable=protected-access
+        coalescer = main._TileCoalescer(window=0.2)
+        slide = FakeSlide()
+        slide.gate.clear()
+        results = {}
+
+        def request(address):
+            results[address] = coalescer.get_tile("slide", slide, 5, address)
+
+        first = threading.Thread(target=request, args=((1, 1),))
+        first.start()
+        # wait until the first read is in flight
+        while not coalescer._reading:
+            time.sleep(0.001)
+        others = [
+            threading.Thread(target=request, args=(address,))
+            for address in ((2, 1), (1, 2))
+        ]
+        for thread in others:
+            thread.start()
+        for thread in others:
+            thread.join()
+        slide.gate.set()
+        first.join()
+        self.assertEqual(
+            slide.reads,
+            [
+                ("get_tiles", 5, [(1, 2), (2, 1)]),
+                ("get_tile", 5, (1, 1)),
+            ],
+        )
+        self.assertEqual(
+            {address: tile.size for address, tile in results.items()},
+            {(1, 1): (1, 1), (2, 1): (2, 1), (1, 2): (1, 2)},
+        )
+        self.assertEqual(coalescer._reading, {})
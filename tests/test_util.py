@@ -0,0 +1,73 @@
+import math
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# pylint: disable=wrong-import-position
+
+from dz_py.util import LazyMapping, max_dzi_level, morton_order
+
+
+class LazyMappingTest(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+
+        def loader(key):
+            self.calls.append(key)
+            return key.upper()
+
+        self.mapping = LazyMapping(["a", "b"], loader)
+
+    def test_loads_once(self):
+        self.assertEqual(list(self.mapping), ["a", "b"])
+        self.assertEqual(len(self.mapping), 2)
+        self.assertEqual(self.calls, [])
+        self.assertEqual(self.mapping["a"], "A")
+        self.assertEqual(self.mapping["a"], "A")
+        self.assertEqual(self.calls, ["a"])
+
+    def test_contains_does_not_load(self):
+        self.assertIn("a", self.mapping)
+        self.assertNotIn("c", self.mapping)
+        self.assertEqual(self.calls, [])
+
+    def test_unknown_key(self):
+        with self.assertRaises(KeyError):
+            self.mapping["c"]  # pylint: disable=pointless-statement
+        self.assertEqual(self.calls, [])
+
+
+class MortonOrderTest(unittest.TestCase):
+    def test_covers_grid(self):
+        order = morton_order(5, 3)
+        self.assertEqual(len(order), 15)
+        self.assertEqual(
+            set(order), {(x, y) for x in range(5) for y in range(3)}
+        )
+
+    def test_z_order(self):
+        self.assertEqual(
+            morton_order(4, 4)[:8],
+            ((0, 0), (1, 0), (0, 1), (1, 1), (2, 0), (3, 0), (2, 1), (3, 1)),
+        )
+
+
+class MaxDziLevelTest(unittest.TestCase):
+    def test_matches_log2(self):
+        for width in range(1, 1100):
+            for height in (1, 7, width, 1024, 1025):
+                self.assertEqual(
+                    max_dzi_level(width, height),
+                    math.ceil(math.log2(max(width, height))),
+                )
+
+    def test_powers_of_two(self):
+        # float log2 may round these to the wrong level
+        for exp in range(64):
+            self.assertEqual(max_dzi_level(2**exp, 1), exp)
+            self.assertEqual(max_dzi_level(1, 2**exp + 1), exp + 1)
+
+
+if __name__ == "__main__":
+    unittest.main()